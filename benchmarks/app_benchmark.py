@@ -0,0 +1,261 @@
+"""
+End to end benchmark of the editor against the fake RAW server of fake_rawapi, runs without a display.
+
+It drives a MainWindow through the scenarios, as the menus do, and reports the percentiles of the time
+until the command is complete (painted in the results for the queries):
+
+    run          runs a different query each time (Query > Run query (bypass cache))
+    run_cached   runs the same query, answered from the results cache
+    fetch_all    runs a query and fetches the rest of its rows (Query > Fetch all)
+    validate     validates a different query each time
+    stop         stops a query waiting for the server, the time until it is cancelled
+    views, materialized_views, packages, s3, rdbms, http
+                 opens the administration and settings dialogs until they are shown
+
+For the commands sent to the server the median of the parts of their timings (queue, server, first row,
+fetch, model, paint) is reported too. The results are written as JSON (to stdout or to --output).
+
+usage: QT_QPA_PLATFORM=offscreen python benchmarks/app_benchmark.py [--iterations 20] [--latency 0.02]
+           [--rows 1000] [--depth 0] [--failure-rate 0] [--scenarios run,validate,stop] [--output results.json]
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import sys
+from time import perf_counter
+
+benchmarks_path = os.path.dirname(os.path.abspath(__file__))
+src_path = os.path.join(benchmarks_path, '..', 'src', 'raw_editor')
+sys.path.insert(0, src_path)
+sys.path.insert(0, benchmarks_path)
+
+from fake_rawapi import FakeRawServer, install
+
+# the editor imports the fake rawapi module, the server is replaced with the settings of the command line
+install()
+
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtCore import QEventLoop, QTimer
+from main_window import MainWindow
+from theme import load_theme
+
+# seconds to wait for a command before counting it as a timeout
+TIMEOUT = 60
+# the stop scenario stops the query after STOP_AFTER seconds of a server that answers in STOP_LATENCY
+STOP_AFTER = 0.05
+STOP_LATENCY = 1.0
+# parts of the timings of the commands
+PARTS = ['queue_wait', 'server', 'first_row', 'fetch', 'model_build', 'paint']
+DIALOGS = dict(views='administration_views', materialized_views='administration_mt_views',
+               packages='administration_packages', s3='s3_settings', rdbms='rdbms_settings', http='http_settings')
+SCENARIOS = ['run', 'run_cached', 'fetch_all', 'validate', 'stop'] + list(DIALOGS)
+
+
+def percentile(values, p):
+    # Nearest rank percentile of the sorted values
+    index = max(0, int(round(p / 100 * len(values))) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def wait_for(condition, timeout=TIMEOUT):
+    # Runs the event loop until condition() is true, returns False after 'timeout' seconds
+    deadline = perf_counter() + timeout
+    loop = QEventLoop()
+    timer = QTimer()
+    timer.setInterval(1)
+    timer.timeout.connect(lambda: (condition() or perf_counter() > deadline) and loop.quit())
+    timer.start()
+    loop.exec_()
+    timer.stop()
+    return bool(condition())
+
+
+def timing_record(window, cmd_id, action):
+    # The complete timings of the command, None until it is complete
+    for record in reversed(window.timings.records):
+        if record['id'] == cmd_id and record['action'] == action:
+            return record
+    return None
+
+
+class Benchmark(object):
+    def __init__(self, window, server, iterations):
+        self.window = window
+        self.server = server
+        self.iterations = iterations
+        self.count = 0
+        # dialogs closed as soon as they are shown, error boxes are counted as errors
+        self.closed_modals = []
+        self.closer = QTimer()
+        self.closer.setInterval(1)
+        self.closer.timeout.connect(self.close_modal)
+
+    def close_modal(self):
+        modal = QApplication.activeModalWidget()
+        if modal is not None:
+            self.closed_modals.append(type(modal).__name__)
+            modal.reject()
+
+    def query_text(self):
+        # a different query each time, so it is not answered from the caches
+        self.count += 1
+        return 'select * from read("s3://bucket/data.csv") where id > %d' % self.count
+
+    def command(self, start, action, text=None):
+        # Runs the command started by start(), returns (seconds, timings record)
+        if text is not None:
+            self.window.editor.setText(text)
+        t = perf_counter()
+        cmd_id = start()
+        if not wait_for(lambda: timing_record(self.window, cmd_id, action) is not None):
+            return None, None
+        return perf_counter() - t, timing_record(self.window, cmd_id, action)
+
+    def run_query(self):
+        return self.command(lambda: self.window.run_query_uncached() or self.window.query_id, 'query',
+                            self.query_text())
+
+    def run_cached(self):
+        return self.command(lambda: self.window.run_query() or self.window.query_id, 'query',
+                            'select * from read("s3://bucket/cached.csv")')
+
+    def fetch_all(self):
+        seconds, record = self.run_query()
+        if record is None or not self.window.fetch_all_action.isEnabled():
+            # all the rows fit in the first page
+            return None, None
+        return self.command(lambda: self.window.fetch_all() or self.window.query_id, 'fetch')
+
+    def validate(self):
+        return self.command(lambda: self.window.validate_query() or self.window.validation_id, 'validate',
+                            self.query_text())
+
+    def stop(self):
+        latency = self.server.latency
+        self.server.latency = STOP_LATENCY
+        try:
+            self.window.editor.setText(self.query_text())
+            self.window.run_query_uncached()
+            cmd_id = self.window.query_id
+            wait_for(lambda: False, STOP_AFTER)
+            return self.command(lambda: self.window.stop_query() or cmd_id, 'query')
+        finally:
+            self.server.latency = latency
+
+    def dialog(self, method):
+        errors = len(self.closed_modals)
+        self.closer.start()
+        t = perf_counter()
+        getattr(self.window, method)()
+        seconds = perf_counter() - t
+        self.closer.stop()
+        # the dialog itself is the last modal closed
+        failed = any(name == 'QMessageBox' for name in self.closed_modals[errors:])
+        return seconds, dict(status='error' if failed else 'done')
+
+    def scenario(self, name):
+        if name in DIALOGS:
+            run = lambda: self.dialog(DIALOGS[name])
+        else:
+            run = dict(run=self.run_query, run_cached=self.run_cached, fetch_all=self.fetch_all,
+                       validate=self.validate, stop=self.stop)[name]
+        if name == 'run_cached':
+            # only complete results are cached, the first run reads all the rows
+            self.run_cached()
+            if self.window.fetch_all_action.isEnabled():
+                self.command(lambda: self.window.fetch_all() or self.window.query_id, 'fetch')
+        latencies = []
+        records = []
+        timeouts = 0
+        for _ in range(self.iterations):
+            seconds, record = run()
+            if seconds is None:
+                timeouts += 1 if record is None and name != 'fetch_all' else 0
+                continue
+            latencies.append(seconds)
+            records.append(record)
+        return summary(name, latencies, records, timeouts)
+
+
+def summary(name, latencies, records, timeouts):
+    result = dict(scenario=name, count=len(latencies), timeouts=timeouts,
+                  errors=sum(1 for record in records if record.get('status', 'done') not in ['done', 'cancelled']))
+    if latencies:
+        latencies = sorted(latencies)
+        result.update(mean_ms=statistics.mean(latencies) * 1000,
+                      p50_ms=percentile(latencies, 50) * 1000,
+                      p90_ms=percentile(latencies, 90) * 1000,
+                      p99_ms=percentile(latencies, 99) * 1000,
+                      max_ms=latencies[-1] * 1000)
+    parts = {}
+    for part in PARTS:
+        values = [record[part] for record in records if part in record]
+        if values:
+            parts[part + '_p50_ms'] = statistics.median(values) * 1000
+    if parts:
+        result['parts'] = parts
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Editor benchmark against a fake RAW server')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma separated scenarios')
+    parser.add_argument('--iterations', type=int, default=20, help='runs of every scenario')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds of every request to the server')
+    parser.add_argument('--row-latency', type=float, default=0, help='seconds to read every row')
+    parser.add_argument('--rows', type=int, default=1000, help='rows of the results')
+    parser.add_argument('--columns', type=int, default=4, help='primitive columns of the results')
+    parser.add_argument('--depth', type=int, default=0, help='levels of nested collections of the results')
+    parser.add_argument('--width', type=int, default=3, help='elements of the nested collections')
+    parser.add_argument('--failure-rate', type=float, default=0, help='probability of a failed request')
+    parser.add_argument('--validation-error-rate', type=float, default=0,
+                        help='probability of a validation with errors')
+    parser.add_argument('--items', type=int, default=20, help='views, packages, buckets... of the server')
+    parser.add_argument('--page-size', type=int, default=MainWindow.PAGE_SIZE, help='rows of the first page')
+    parser.add_argument('--output', help='file for the JSON results (default stdout)')
+    args = parser.parse_args()
+
+    server = install(FakeRawServer(latency=args.latency, row_latency=args.row_latency, rows=args.rows,
+                                   columns=args.columns, depth=args.depth, width=args.width,
+                                   failure_rate=args.failure_rate, validation_error_rate=args.validation_error_rate,
+                                   items=args.items))
+
+    app = QApplication(sys.argv[:1])
+    # stdout is kept for the JSON results
+    with contextlib.redirect_stdout(sys.stderr):
+        theme = load_theme(os.path.join(src_path, 'themes', 'default-theme.json'))
+        # no validations while typing, they would compete with the measured commands
+        window = MainWindow(dict(theme=theme, page_size=args.page_size, validation_debounce=0))
+        window.show()
+        benchmark = Benchmark(window, server, args.iterations)
+        results = []
+        for name in args.scenarios.split(','):
+            result = benchmark.scenario(name)
+            print('%-20s p50 %8.1f ms  p90 %8.1f ms  p99 %8.1f ms  (%d runs, %d errors, %d timeouts)' % (
+                name, result.get('p50_ms', 0), result.get('p90_ms', 0), result.get('p99_ms', 0),
+                result['count'], result['errors'], result['timeouts']), file=sys.stderr)
+            results.append(result)
+        stalls = len(window.stall_watchdog.stalls) if window.stall_watchdog is not None else None
+        window.close()
+
+    report = dict(
+        python=platform.python_version(),
+        platform=platform.platform(),
+        settings=vars(args),
+        requests=server.requests,
+        failed_requests=server.failures,
+        stalls=stalls,
+        results=results,
+    )
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+"""
+In-process fake of the RAW server for the benchmarks, it implements the methods of the rawapi client
+used by the editor (query with its type, query_validate and the views, materialized views, packages,
+buckets, rdbms and http_auth catalogs) without a network.
+
+Every request waits 'latency' seconds (+- 'jitter' of it) and fails with a RawException with the
+probability 'failure_rate'. The results of the queries are 'rows' generated records of 'columns'
+primitive fields, each record with a nested collection of 'width' records down to 'depth' levels
+(depth 0 is a table).
+
+install() registers the fake as the rawapi module, it must be called before importing the editor:
+
+    server = install(FakeRawServer(latency=0.05, rows=10000))
+    import main_window
+"""
+import random
+import sys
+import threading
+import types
+
+
+class RawException(Exception):
+    pass
+
+
+# (type, value of row n) of the primitive columns, repeated when there are more columns
+PRIMITIVES = [
+    ('int', lambda n: n),
+    ('string', lambda n: 'name %d' % n),
+    ('double', lambda n: n * 0.5),
+    ('bool', lambda n: n % 2 == 0),
+    ('date', lambda n: '2020-01-%02d' % (n % 28 + 1)),
+    ('long', lambda n: n * 1000003),
+]
+
+
+def type_text(tipe):
+    # Type as written in RQL, as answered by query_validate
+    if tipe['type'] == 'collection':
+        return 'collection(%s)' % type_text(tipe['inner'])
+    elif tipe['type'] == 'record':
+        return 'record(%s)' % ', '.join('%s: %s' % (att['idn'], type_text(att['type'])) for att in tipe['atts'])
+    return tipe['type']
+
+
+class FakeResult(object):
+    # Iterator of the rows of a collection, every row takes 'row_latency' seconds
+    def __init__(self, client, server, count):
+        self.client = client
+        self.server = server
+        self.count = count
+        self.n = 0
+        self.closed = False
+
+    def next(self):
+        if self.closed or self.n >= self.count:
+            raise StopIteration()
+        if self.server.row_latency:
+            self.client.wait(self.server.row_latency)
+        row = self.server.record(self.n, self.server.depth)
+        self.n += 1
+        return row
+
+    __next__ = next
+
+    def __iter__(self):
+        return self
+
+    def close(self):
+        self.closed = True
+
+
+class FakeRawServer(object):
+    # Settings and catalogs shared by the clients
+    def __init__(self, latency=0.01, jitter=0.2, row_latency=0, rows=1000, columns=4, depth=0, width=3,
+                 failure_rate=0, validation_error_rate=0, items=20, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.row_latency = row_latency
+        self.rows = rows
+        self.columns = columns
+        self.depth = depth
+        self.width = width
+        self.failure_rate = failure_rate
+        self.validation_error_rate = validation_error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.views = {}
+        self.materialized_views = {}
+        self.packages = {}
+        self.buckets = {}
+        self.rdbms = {}
+        self.http_auth = {}
+        for n in range(items):
+            query = 'select * from read("s3://bucket/data%d.csv") where id > %d' % (n, n)
+            self.views['view%d' % n] = query
+            self.materialized_views['materialized%d' % n] = query
+            self.packages['package%d' % n] = 'f%d(x: int) := x + %d' % (n, n)
+            self.buckets['bucket%d' % n] = dict(name='bucket%d' % n, region='eu-west-1',
+                                                credentials=dict(access_key='key%d' % n) if n % 2 else None)
+            self.rdbms['db%d' % n] = dict(type='postgresql', host='host%d' % n, database='db%d' % n,
+                                          port=5432, username='user%d' % n)
+            self.http_auth['http%d' % n] = dict(credentials=dict(type='basic', user='user%d' % n))
+
+    def request(self):
+        # Seconds of the next request, raises a RawException for the failed ones
+        with self.lock:
+            self.requests += 1
+            seconds = self.latency * (1 + self.jitter * (2 * self.random.random() - 1))
+            failed = self.random.random() < self.failure_rate
+            if failed:
+                self.failures += 1
+        return seconds, failed
+
+    def validation_failed(self):
+        with self.lock:
+            return self.random.random() < self.validation_error_rate
+
+    def record_type(self, depth):
+        atts = [dict(idn='%s%d' % (PRIMITIVES[n % len(PRIMITIVES)][0], n),
+                     type=dict(type=PRIMITIVES[n % len(PRIMITIVES)][0]))
+                for n in range(self.columns)]
+        if depth > 0:
+            atts.append(dict(idn='children', type=self.collection_type(depth - 1)))
+        return dict(type='record', atts=atts)
+
+    def collection_type(self, depth):
+        return dict(type='collection', inner=self.record_type(depth))
+
+    def record(self, n, depth):
+        row = dict(('%s%d' % (PRIMITIVES[c % len(PRIMITIVES)][0], c), PRIMITIVES[c % len(PRIMITIVES)][1](n + c))
+                   for c in range(self.columns))
+        if depth > 0:
+            row['children'] = [self.record(n * self.width + c, depth - 1) for c in range(self.width)]
+        return row
+
+
+class FakeRawClient(object):
+    # The requests are interrupted when the client is closed, as closing the connection of the real one
+    def __init__(self, server):
+        self.server = server
+        self.closed = threading.Event()
+
+    def wait(self, seconds):
+        if self.closed.wait(seconds):
+            raise ConnectionError('the connection was closed')
+
+    def close(self):
+        self.closed.set()
+
+    def request(self):
+        seconds, failed = self.server.request()
+        self.wait(seconds)
+        if failed:
+            raise RawException('simulated failure of the server')
+
+    def query(self, query, with_type=False):
+        self.request()
+        tipe = self.server.collection_type(self.server.depth)
+        data = FakeResult(self, self.server, self.server.rows)
+        if with_type:
+            return data, tipe
+        return data
+
+    def query_validate(self, query):
+        self.request()
+        if self.server.validation_failed():
+            position = dict(begin=dict(line=1, column=1), end=dict(line=1, column=max(2, len(query.split('\n')[0]))))
+            return dict(errors=[dict(message='simulated error', positions=[position])], type=None)
+        return dict(errors=[], type=type_text(self.server.collection_type(self.server.depth)))
+
+    def catalog_list(self, catalog):
+        self.request()
+        with self.server.lock:
+            return sorted(catalog)
+
+    def catalog_show(self, catalog, name):
+        self.request()
+        with self.server.lock:
+            if name not in catalog:
+                raise RawException('%s not found' % name)
+            return catalog[name]
+
+    def catalog_set(self, catalog, name, value):
+        self.request()
+        with self.server.lock:
+            catalog[name] = value
+
+    def catalog_drop(self, catalog, name):
+        self.request()
+        with self.server.lock:
+            if catalog.pop(name, None) is None:
+                raise RawException('%s not found' % name)
+
+    def views_list_names(self):
+        return self.catalog_list(self.server.views)
+
+    def views_show(self, name):
+        return dict(name=name, query=self.catalog_show(self.server.views, name))
+
+    def views_create(self, name, query):
+        self.catalog_set(self.server.views, name, query)
+
+    def views_drop(self, name):
+        self.catalog_drop(self.server.views, name)
+
+    def materialized_views_list_names(self):
+        return self.catalog_list(self.server.materialized_views)
+
+    def materialized_views_show(self, name):
+        return dict(name=name, query=self.catalog_show(self.server.materialized_views, name))
+
+    def materialized_views_create(self, name, query):
+        self.catalog_set(self.server.materialized_views, name, query)
+
+    def materialized_views_drop(self, name):
+        self.catalog_drop(self.server.materialized_views, name)
+
+    def packages_list_names(self):
+        return self.catalog_list(self.server.packages)
+
+    def packages_show(self, name):
+        return dict(name=name, query=self.catalog_show(self.server.packages, name))
+
+    def packages_create(self, name, query):
+        self.catalog_set(self.server.packages, name, query)
+
+    def packages_drop(self, name):
+        self.catalog_drop(self.server.packages, name)
+
+    def buckets_list(self):
+        return self.catalog_list(self.server.buckets)
+
+    def buckets_show(self, name):
+        return self.catalog_show(self.server.buckets, name)
+
+    def buckets_register(self, name, region, access_key, secret_key):
+        credentials = dict(access_key=access_key) if access_key else None
+        self.catalog_set(self.server.buckets, name, dict(name=name, region=region, credentials=credentials))
+
+    def buckets_unregister(self, name):
+        self.catalog_drop(self.server.buckets, name)
+
+    def rdbms_list(self):
+        return self.catalog_list(self.server.rdbms)
+
+    def rdbms_show(self, name):
+        return self.catalog_show(self.server.rdbms, name)
+
+    def rdbms_register(self, tipe, name, host, database, port, username):
+        self.catalog_set(self.server.rdbms, name, dict(type=tipe, host=host, database=database, port=port,
+                                                       username=username))
+
+    def rdbms_register_postgresql(self, name, host, database, port, username, password):
+        self.rdbms_register('postgresql', name, host, database, port, username)
+
+    def rdbms_register_mysql(self, name, host, database, port, username, password):
+        self.rdbms_register('mysql', name, host, database, port, username)
+
+    def rdbms_register_sqlserver(self, name, host, database, port, username, password):
+        self.rdbms_register('sqlserver', name, host, database, port, username)
+
+    def rdbms_register_oracle(self, name, host, database, port, username, password):
+        self.rdbms_register('oracle', name, host, database, port, username)
+
+    def rdbms_register_teradata(self, name, host, port, username, password, options):
+        self.catalog_set(self.server.rdbms, name, dict(type='teradata', host=host, port=port, username=username))
+
+    def rdbms_unregister(self, name):
+        self.catalog_drop(self.server.rdbms, name)
+
+    def http_auth_list(self):
+        return self.catalog_list(self.server.http_auth)
+
+    def http_auth_show(self, name):
+        return self.catalog_show(self.server.http_auth, name)
+
+    def http_auth_register(self, name, credentials):
+        self.catalog_set(self.server.http_auth, name, dict(credentials=credentials))
+
+    def http_auth_unregister(self, name):
+        self.catalog_drop(self.server.http_auth, name)
+
+
+def install(server=None):
+    # Registers a rawapi module whose clients use 'server', returns the server.
+    # Installed again, the new clients use the new server
+    server = server or FakeRawServer()
+    module = sys.modules.get('rawapi')
+    if not isinstance(module, types.ModuleType) or getattr(module, 'fake_server', None) is None:
+        module = types.ModuleType('rawapi')
+        module.RawException = RawException
+        module.new_raw_client = lambda *args, **kwargs: FakeRawClient(module.fake_server)
+        sys.modules['rawapi'] = module
+    module.fake_server = server
+    return server
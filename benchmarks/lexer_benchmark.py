@@ -0,0 +1,189 @@
+"""
+Benchmark of the RawLexer on synthetic RQL documents, runs without a display.
+
+For every size it reports the time to style the whole document through styleText,
+the throughput of the tokenizer used by the worker thread, the peak memory allocated
+by python while styling and the cost of restyling after a keystroke.
+The results are written as JSON (to stdout or to --output) to compare releases.
+
+usage: QT_QPA_PLATFORM=offscreen python benchmarks/lexer_benchmark.py [--sizes 10K,1M,50M] [--output results.json]
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import sys
+import time
+import tracemalloc
+
+src_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'raw_editor')
+sys.path.insert(0, src_path)
+
+from PyQt5.QtWidgets import QApplication
+from PyQt5.Qsci import QSCINTILLA_VERSION_STR
+from rql_editor import RqlEditor, QsciScintilla
+from theme import load_theme
+
+# lines styled after a keystroke, about the visible part of the editor
+VIEWPORT_LINES = 60
+KEYSTROKES = 20
+
+
+def parse_size(s):
+    units = dict(K=1024, M=1024 * 1024)
+    if s[-1].upper() in units:
+        return int(float(s[:-1]) * units[s[-1].upper()])
+    return int(s)
+
+
+def generate_corpus(size, lexer, seed=0):
+    # Random RQL like text made of the words of the lexer, identifiers, strings, numbers,
+    # operators and comments. Returns the text and the number of (non blank) tokens
+    rnd = random.Random(seed)
+    words = lexer.keywords + lexer.builtin_functions + lexer.constants
+    identifiers = ['a', 'b', 'people', 'salary', 'name', 'x1', 'total_count']
+    operators = [':=', '+', '-', '*', '/', '<', '>', '==', '<>', ',', ';', '.']
+    parens = ['(', ')', '[', ']', '{', '}']
+
+    def token():
+        n = rnd.random()
+        if n < 0.3:
+            return rnd.choice(words)
+        elif n < 0.5:
+            return rnd.choice(identifiers)
+        elif n < 0.6:
+            return '"%s"' % rnd.choice(identifiers)
+        elif n < 0.7:
+            return rnd.choice(['1', '42', '3.14', '1e10', '-7'])
+        elif n < 0.85:
+            return rnd.choice(operators)
+        else:
+            return rnd.choice(parens)
+
+    lines = []
+    tokens = 0
+    total = 0
+    while total < size:
+        n = rnd.random()
+        if n < 0.05:
+            line = '// ' + ' '.join(rnd.choice(words) for _ in range(6))
+            tokens += 1
+        elif n < 0.07:
+            line = '"""' + ' '.join(rnd.choice(words) for _ in range(4)) + '\n' + ' '.join(
+                rnd.choice(identifiers) for _ in range(4)) + '"""'
+            tokens += 1
+        else:
+            ntokens = rnd.randint(5, 15)
+            line = ' '.join(token() for _ in range(ntokens))
+            tokens += ntokens
+        lines.append(line)
+        total += len(line) + 1
+    return '\n'.join(lines) + '\n', tokens
+
+
+def new_editor(text, theme):
+    editor = RqlEditor(theme)
+    editor.SendScintilla(QsciScintilla.SCI_SETTEXT, text)
+    return editor
+
+
+def style_all(editor):
+    start = time.perf_counter()
+    editor.SendScintilla(QsciScintilla.SCI_COLOURISE, 0, -1)
+    return time.perf_counter() - start
+
+
+def keystroke_cost(editor, line):
+    # Types a character at the beginning of 'line' and styles the visible lines, as Scintilla does
+    times = []
+    for n in range(KEYSTROKES):
+        pos = editor.SendScintilla(QsciScintilla.SCI_POSITIONFROMLINE, line)
+        end = editor.SendScintilla(QsciScintilla.SCI_POSITIONFROMLINE, line + VIEWPORT_LINES)
+        if end < 0:
+            end = editor.length()
+        if n % 2 == 0:
+            editor.SendScintilla(QsciScintilla.SCI_INSERTTEXT, pos, b'x')
+        else:
+            editor.SendScintilla(QsciScintilla.SCI_DELETERANGE, pos, 1)
+        start = time.perf_counter()
+        editor.SendScintilla(QsciScintilla.SCI_COLOURISE, pos, end)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def run(size, theme):
+    editor = RqlEditor(theme)
+    text, tokens = generate_corpus(size, editor.lexer)
+    data = text.encode()
+    mb = len(data) / (1024 * 1024)
+
+    editor = new_editor(data, theme)
+    style_seconds = style_all(editor)
+    lines = editor.lines()
+    keystroke_top = keystroke_cost(editor, 1)
+    keystroke_middle = keystroke_cost(editor, lines // 2)
+
+    tokenizer = editor.lexer.tokenizer
+    start = time.perf_counter()
+    tokenizer.tokenize(data)
+    tokenize_seconds = time.perf_counter() - start
+
+    editor = new_editor(data, theme)
+    tracemalloc.start()
+    style_all(editor)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return dict(
+        size_bytes=len(data),
+        lines=lines,
+        tokens=tokens,
+        style_seconds=style_seconds,
+        mb_per_second=mb / style_seconds,
+        tokens_per_second=tokens / style_seconds,
+        tokenize_seconds=tokenize_seconds,
+        tokenize_mb_per_second=mb / tokenize_seconds,
+        peak_python_memory_bytes=peak_memory,
+        max_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        keystroke_top_ms=keystroke_top,
+        keystroke_middle_ms=keystroke_middle,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='RawLexer benchmark')
+    parser.add_argument('--sizes', default='10K,100K,1M,10M,50M', help='comma separated sizes (K and M suffixes)')
+    parser.add_argument('--output', help='file for the JSON results (default stdout)')
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv[:1])
+    # stdout is kept for the JSON results
+    with contextlib.redirect_stdout(sys.stderr):
+        theme = load_theme(os.path.join(src_path, 'themes', 'default-theme.json'))['Editor']
+    results = []
+    for size in args.sizes.split(','):
+        result = run(parse_size(size), theme)
+        print('%9d bytes: %.2f MB/s, %d tokens/s, keystroke %.2f ms (top) %.2f ms (middle)' % (
+            result['size_bytes'], result['mb_per_second'], result['tokens_per_second'],
+            result['keystroke_top_ms'], result['keystroke_middle_ms']), file=sys.stderr)
+        results.append(result)
+
+    report = dict(
+        python=platform.python_version(),
+        qscintilla=QSCINTILLA_VERSION_STR,
+        platform=platform.platform(),
+        results=results,
+    )
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""
+Compares the throughput of the RawLexer tokenizer against the previous implementation (LegacyLexer,
+its styleText loop copied as it was), which tried every regex anchored with ^ at each position of the
+whole range and sliced the rest of the text after every token, so styling a range was quadratic in its size.
+Both style the same ranges of several MB (the legacy side takes minutes for 4 MB).
+
+usage: QT_QPA_PLATFORM=offscreen python benchmarks/tokenizer_throughput.py [size in MB ...]
+"""
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'raw_editor'))
+
+from PyQt5.QtWidgets import QApplication
+from rql_editor import RawLexer
+
+sample = r'''typealias person := record(name: string, age: int, salary: double);
+a := select * from read("dropbox://cesar/test") where age > 18 and salary <= 1.5e3;
+b := "\"hello\" \"world\"";
+// some comment about the query
+c := select name, count(*) from a group by name having count(*) > 2;
+d := """multi line
+string with "quotes" inside""";
+e := coalesce(null, to_date("2019-01-01", "yyyy-MM-dd"), ccount(a));
+'''
+
+
+class LegacyLexer(object):
+    # The tokenizer of RawLexer before the single pass one, copied as it was: it styles the whole range
+    # with the regexes anchored with ^ and slices the text after every token
+    def __init__(self):
+        self.styles = dict((name, n) for n, name in enumerate(
+            ['default', 'keywords', 'constants', 'comments', 'strings', 'builtInFunctions', 'operators', 'parens',
+             'numbers']))
+        self.regexes = []
+        self.tokens = 0
+
+        self.keywords = ['select', 'distinct', 'from', 'where', 'group', 'by', 'having', 'in',
+                         'union', 'order', 'desc', 'asc', 'if', 'then', 'else', 'parse',
+                         'parse?', 'into', 'not', 'and', 'or', 'flatten', 'like', 'as',
+                         'all', 'cast', 'partition', 'on', 'error', 'fail', 'skip',
+                         'when', 'coalesce', 'enumerate']
+
+        self.builtin_functions = ['avg', 'count', 'exists', 'max', 'min', 'sum', 'trim', 'startswith',
+                                  'cavg', 'ccount', 'cmax', 'cmin', 'csum', 'isnull', 'isnone',
+                                  'date_trunc', 'strempty', 'to_date', 'to_time', 'to_timestamp', 'enumerate',
+                                  'read', 'read_many', 'read_csv', 'read_json','read_xml', 'read_pgsql',
+                                  'read_mysql', 'read_oracle', 'read_sqlserver',
+                                  'read_sqlite', 'query_pgsql', 'query_mysql', 'query_oracle', 'query_sqlserver',
+                                  'try_read', 'try_read_many', 'try_read_csv', 'try_read_json', 'try_read_xml',
+                                  'try_read_pgsql', 'try_read_mysql', 'try_read_oracle',
+                                  'try_read_sqlserver', 'try_read_hive', 'try_read_sqlite', 'try_query_pgsql',
+                                  'try_query_mysql', 'try_query_oracle', 'try_query_sqlserver',
+                                  'ls', 'ls_schemas', 'ls_tables', 'parse_json', 'parse_csv', 'parse_xml',
+                                  'http']
+
+        self.constants = ['typealias', 'true', 'false', 'null', 'none', 'string', 'int',
+                          'long', 'short', 'byte', 'float', 'double', 'decimal',
+                          'date', 'time', 'timestamp', 'interval', 'bool', 'collection',
+                          'array', 'record', 'format', 'auto', 'csv', 'json',
+                          'excel', 'hjson', 'xml', 'text', 'nullif']
+
+        self.add_match('keywords', self.keywords)
+        self.add_match('builtInFunctions', self.builtin_functions)
+        self.add_match('constants', self.constants)
+        self.add_match('numbers', r'\b[+-]?\d+(?:(?:\.\d*)?(?:[e][+-]?\d+)?)?\b')
+        self.add_match('comments', r'\/\/[^\n]*')
+        self.add_match('operators', r':|\+|\-|\/|%|<@>|@>|<@|&|\^|~|<|>|<=|=>|==|!=|:=|<>|=')
+
+        self.add_match('parens', r"[\(\[\{\)\]\}]")
+        self.add_match('strings', r'r?"(?:[^"\\]|\\.)*"')
+
+        # when nothing else matches takes the next token
+        self.next_token = re.compile(r'^\s+|\w+|\W')
+
+    def add_match(self, style, obj, case_sensitive=False):
+        if isinstance(obj, str):
+            regex = obj
+        elif isinstance(obj, list):
+            regex = r'|'.join([r'\b' + r + r'\b' for r in obj])
+        else:
+            raise Exception('match can only be a string or a list of keywords')
+
+        # adds the ^ at the beginning to match only at the beginning of the string
+        if not case_sensitive:
+            r = re.compile("^" + regex, re.IGNORECASE)
+        else:
+            r = re.compile("^" + regex)
+        style_number = self.styles[style]
+        self.regexes.append((r, style_number))
+
+    def setStyling(self, length, style):
+        self.tokens += 1
+
+    def styleText(self, text):
+        # the loop of RawLexer.styleText on the text of the whole range
+
+        # Tries a regex and if it matches applies the style and removes token from text
+        def try_match(regex, style):
+            nonlocal text
+            m = regex.match(text)
+            if m:
+                token = m.group(0)
+                self.setStyling(len(token), style)
+                text = text[len(token):]
+                return True
+            return False
+
+        while text:
+            for (regex, style) in self.regexes:
+                if try_match(regex, style):
+                    continue
+            # if noting matches sets the default style (0)
+            try_match(self.next_token, 0)
+
+
+def run(text, style_line):
+    # Styles the whole text as one range line by line, as RawLexer.styleText does
+    start = time.perf_counter()
+    state = RawLexer.DEFAULT
+    pos = 0
+    while pos < len(text):
+        end = text.find(b'\n', pos) + 1 or len(text)
+        state = style_line(text, pos, end, state)
+        pos = end
+    return time.perf_counter() - start
+
+
+def main():
+    app = QApplication(sys.argv[:1])
+    sizes = [float(s) for s in sys.argv[1:]] or [1, 2, 4]
+
+    for size in sizes:
+        text = (sample * int(size * 1024 * 1024 / len(sample))).encode()
+        mb = len(text) / (1024 * 1024)
+
+        legacy = LegacyLexer()
+        start = time.perf_counter()
+        # the old styleText took the range as a str
+        legacy.styleText(text.decode())
+        legacy_time = time.perf_counter() - start
+
+        lexer = RawLexer()
+        styles = bytearray(len(text))
+        current_time = run(text, lambda *args: lexer.tokenizer.style_line(*args, styles))
+
+        print('%.1f MB: legacy %.3f MB/s (%d tokens), current %.2f MB/s, speedup %.0fx' % (
+            mb, mb / legacy_time, legacy.tokens, mb / current_time, legacy_time / current_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -16,7 +16,7 @@ setup(
     install_requires=[
         'rawapi',
         'PyQt5>=5.11.0',
-        'QScintilla>=2.10.0'
+        'QScintilla>=2.11.0'
     ],
     entry_points={
         'gui_scripts': [
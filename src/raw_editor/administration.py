@@ -3,6 +3,7 @@ from PyQt5.QtWidgets import *
 from rql_editor import RqlEditor
 from settings import exception_dialog
 from rawapi import new_raw_client
+from tracing import traced
 
 
 class ListTable(QTableWidget):
@@ -23,6 +24,7 @@ class ListTable(QTableWidget):
 
 
 class ListEditorWidget(QDialog):
+    @traced()
     def __init__(self, title):
         super(ListEditorWidget, self).__init__()
         self.setWindowTitle(title)
@@ -49,6 +51,7 @@ class ListEditorWidget(QDialog):
         self.refresh()
 
     @exception_dialog
+    @traced()
     def refresh(self):
         self.editor.setText("")
         self.items = self.list_items()
@@ -71,11 +74,6 @@ class ListEditorWidget(QDialog):
             self.delete_item(self.current_name)
             self.refresh()
 
-    def closeEvent(self, evnt):
-        # kills the undo process
-        self.editor.stop()
-
-
     def item_clicked(self, item):
         raise NotImplementedError()
 
@@ -87,6 +85,7 @@ class ListEditorWidget(QDialog):
 
 
 class ViewsWindow(ListEditorWidget):
+    @traced()
     def __init__(self):
         super(ViewsWindow, self).__init__("Views")
 
@@ -102,6 +101,7 @@ class ViewsWindow(ListEditorWidget):
 
 
 class MaterializedViewsWindow(ListEditorWidget):
+    @traced()
     def __init__(self):
         super(MaterializedViewsWindow, self).__init__("Materialized Views")
 
@@ -117,6 +117,7 @@ class MaterializedViewsWindow(ListEditorWidget):
 
 
 class PackagesWindow(ListEditorWidget):
+    @traced()
     def __init__(self):
         super(PackagesWindow, self).__init__("Packages")
 
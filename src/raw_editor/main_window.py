@@ -9,15 +9,21 @@ from rql_editor import RqlEditor
 from query_results import QueryView
 
 from query_client import AsyncQueryClient
+from query_timings import QueryTimings
+from tracing import tracer, traced
+from stall_watchdog import StallWatchdog
 from settings import *
 from administration import *
 from theme import *
 import json
+from time import perf_counter
 
 import resources
 
 
 class MainWindow(QMainWindow):
+    # rows of a collection fetched at once, the next pages are fetched on demand
+    PAGE_SIZE = 100
 
     def __init__(self, conf, *args, **kwargs):
         super(MainWindow, self).__init__(*args, **kwargs)
@@ -25,9 +31,33 @@ class MainWindow(QMainWindow):
         if not conf:
             conf = dict(theme=dict(Widgets=None, Editor=None, QueryView=None))
         layout = QVBoxLayout()
-        self.editor = RqlEditor(conf['theme']['Editor'])
+        self.editor = RqlEditor(conf['theme']['Editor'],
+                                idle_styling_budget=conf.get('idle_styling_budget', RqlEditor.IDLE_STYLING_BUDGET),
+                                validation_debounce=conf.get('validation_debounce', RqlEditor.VALIDATION_DEBOUNCE))
         self.query_results = QueryView(conf['theme']['QueryView'])
 
+        self.page_size = conf.get('page_size', self.PAGE_SIZE)
+        self.cursor_idle_timeout = conf.get('cursor_idle_timeout', AsyncQueryClient.CURSOR_IDLE_TIMEOUT)
+        self.query_workers = conf.get('query_workers', AsyncQueryClient.WORKERS)
+        self.query_queue_size = conf.get('query_queue_size', AsyncQueryClient.QUEUE_SIZE)
+        # size of the results cache in MB and seconds its results are valid
+        self.result_cache_size = conf.get('result_cache_size', AsyncQueryClient.CACHE_SIZE // (1024 * 1024))
+        self.result_cache_ttl = conf.get('result_cache_ttl', AsyncQueryClient.CACHE_TTL)
+        # ids of the last query and validation, the answers to older commands are ignored
+        self.query_id = None
+        self.validation_id = None
+        # True while the last query fetches a page asked with the menu
+        self.fetch_pending = False
+        # validation sent while typing and the revision of the document it validates
+        self.live_validation_id = None
+        self.live_validation_revision = None
+        # commands shown with the spinning animation until they answer
+        self.waiting = set()
+        # rows of the last query shown in the results
+        self.rows_shown = 0
+        # timings of the commands, the last one is shown in the status bar
+        self.timings = QueryTimings()
+        self.paint_start = 0
         self.init_client()
 
         # self.path holds the path of the currently open file.
@@ -44,6 +74,25 @@ class MainWindow(QMainWindow):
         self.status = QStatusBar()
         self.setStatusBar(self.status)
 
+        # progress of the syntax highlighting of big documents
+        self.styling_label = QLabel()
+        self.styling_label.hide()
+        self.status.addPermanentWidget(self.styling_label)
+        self.editor.styling_progress.connect(self.styling_progress)
+
+        self.timing_label = QLabel()
+        self.status.addPermanentWidget(self.timing_label)
+        self.query_results.painted.connect(self.results_painted)
+        self.editor.validation_requested.connect(self.live_validate)
+
+        # the event loop blocked for more than stall_threshold ms is reported (0 disables it)
+        self.stall_watchdog = None
+        stall_threshold = conf.get('stall_threshold', StallWatchdog.THRESHOLD * 1000)
+        if stall_threshold > 0:
+            self.stall_watchdog = StallWatchdog(stall_threshold / 1000, self)
+            self.stall_watchdog.stalled.connect(self.interface_stalled)
+            self.stall_watchdog.start()
+
         file_toolbar = QToolBar("File")
         file_toolbar.setIconSize(QSize(24, 24))
         self.addToolBar(file_toolbar)
@@ -133,6 +182,13 @@ class MainWindow(QMainWindow):
         shortcut = QShortcut(QKeySequence("Ctrl+Return"), self)
         shortcut.activated.connect(self.run_query)
 
+        run_uncached_action = QAction("Run query (bypass cache)", self)
+        run_uncached_action.setStatusTip("Run query on the server even if its result is in the cache")
+        run_uncached_action.triggered.connect(self.run_query_uncached)
+        query_menu.addAction(run_uncached_action)
+        shortcut = QShortcut(QKeySequence("Ctrl+Alt+Return"), self)
+        shortcut.activated.connect(self.run_query_uncached)
+
         validate_query_action = QAction(QIcon(':images/validate.png'), "Validate query", self)
         validate_query_action.setStatusTip("Validate query")
         validate_query_action.triggered.connect(self.validate_query)
@@ -141,6 +197,26 @@ class MainWindow(QMainWindow):
         shortcut = QShortcut(QKeySequence("Ctrl+Shift+Return"), self)
         shortcut.activated.connect(self.validate_query)
 
+        # the result of the last query is kept open to fetch more rows
+        self.fetch_page_action = QAction("Fetch next page", self)
+        self.fetch_page_action.setStatusTip("Fetch the next rows of the result")
+        self.fetch_page_action.triggered.connect(self.fetch_page)
+        self.fetch_page_action.setEnabled(False)
+        query_menu.addAction(self.fetch_page_action)
+        shortcut = QShortcut(QKeySequence("Ctrl+Down"), self)
+        shortcut.activated.connect(self.fetch_page)
+
+        self.fetch_all_action = QAction("Fetch all", self)
+        self.fetch_all_action.setStatusTip("Fetch all the rows of the result")
+        self.fetch_all_action.triggered.connect(self.fetch_all)
+        self.fetch_all_action.setEnabled(False)
+        query_menu.addAction(self.fetch_all_action)
+
+        export_timings_action = QAction("Export timings...", self)
+        export_timings_action.setStatusTip("Save the timings of the last commands as JSON lines")
+        export_timings_action.triggered.connect(self.export_timings)
+        query_menu.addAction(export_timings_action)
+
         stop_query_action = QAction(QIcon(':images/stop.png'), "Stop query", self)
         stop_query_action.setStatusTip("Stop query")
         stop_query_action.triggered.connect(self.stop_query)
@@ -191,17 +267,41 @@ class MainWindow(QMainWindow):
         http_action.triggered.connect(self.http_settings)
         settings_menu.addAction(http_action)
 
+        settings_menu.addSeparator()
+        self.trace_action = QAction("Record trace", self)
+        self.trace_action.setStatusTip("Record where the time is spent in a Chrome trace file")
+        self.trace_action.setCheckable(True)
+        self.trace_action.setChecked(tracer.enabled)
+        self.trace_action.triggered.connect(self.toggle_trace)
+        settings_menu.addAction(self.trace_action)
+
+        stall_report_action = QAction("Stall report...", self)
+        stall_report_action.setStatusTip("Save the code that blocked the interface the most time")
+        stall_report_action.triggered.connect(self.save_stall_report)
+        stall_report_action.setEnabled(self.stall_watchdog is not None)
+        settings_menu.addAction(stall_report_action)
+
         self.update_title()
         self.show()
 
     def init_client(self):
-        self.client = AsyncQueryClient(self)
+        self.client = AsyncQueryClient(self, workers=self.query_workers, queue_size=self.query_queue_size,
+                                       cursor_idle_timeout=self.cursor_idle_timeout,
+                                       cache_size=self.result_cache_size * 1024 * 1024,
+                                       cache_ttl=self.result_cache_ttl)
         self.client.query_done.connect(self.query_done)
+        self.client.rows_fetched.connect(self.rows_fetched)
+        self.client.fetch_finished.connect(self.fetch_finished)
+        self.client.cursor_closed.connect(self.cursor_closed)
+        self.client.cancelled.connect(self.query_cancelled)
         self.client.query_validated.connect(self.query_validated)
         self.client.error.connect(self.query_error)
+        self.client.rejected.connect(self.command_rejected)
+        self.client.timing.connect(self.command_timing)
 
-    def start_spin(self):
-        self.editor.setEnabled(False)
+    def start_spin(self, cmd_id):
+        # the editor stays enabled, the commands run in the background
+        self.waiting.add(cmd_id)
         # If the editor has a light color paper load animation1
         # if it is darker loads animation 2
         paper_color = self.editor.lexer.defaultPaper()
@@ -217,20 +317,78 @@ class MainWindow(QMainWindow):
         animation.setVisible(True)
         movie.start()
 
-    def stop_spin(self):
+    def styling_progress(self, percent):
+        if percent < 100:
+            self.styling_label.setText('highlighting %d%%' % percent)
+            self.styling_label.show()
+        else:
+            self.styling_label.hide()
+
+    def stop_spin(self, cmd_id=None):
+        # stops when all the commands answered (or all of them with None)
+        if cmd_id is None:
+            self.waiting.clear()
+        else:
+            self.waiting.discard(cmd_id)
+        if self.waiting:
+            return
         self.movie1.stop()
         self.animation1.hide()
         self.movie2.stop()
         self.animation2.hide()
-        self.editor.setEnabled(True)
 
     def run_query(self):
-        if self.client.executing_cmd:
-            self.status.showMessage('another command is executing', 5000)
-            return
-        self.start_spin()
+        self.start_query(use_cache=True)
+
+    def run_query_uncached(self):
+        self.start_query(use_cache=False)
+
+    def start_query(self, use_cache):
+        # the same query (without comments and formatting) is answered from the results cache
+        self.close_query()
+        self.set_fetch_enabled(False)
+        self.fetch_pending = False
         query = self.editor.text()
-        self.client.query(query)
+        self.query_id = self.client.query(query, self.page_size, cache_key=self.editor.normalized_text(),
+                                          use_cache=use_cache)
+        if self.client.is_running(self.query_id):
+            self.timings.start(self.query_id, 'query', query)
+        if self.client.is_running(self.query_id) and not self.client.is_cached(self.query_id):
+            self.start_spin(self.query_id)
+
+    def close_query(self):
+        # The previous query is cancelled, or its result closed, as it is replaced by a new one
+        if self.query_id is None:
+            return
+        if self.client.is_running(self.query_id):
+            self.client.cancel(self.query_id)
+        elif self.fetch_page_action.isEnabled():
+            self.client.close_result(self.query_id)
+        self.stop_spin(self.query_id)
+        self.timings.finish(self.query_id)
+
+    def fetch_page(self):
+        self.fetch_rows(self.page_size)
+
+    def fetch_all(self):
+        self.fetch_rows(None)
+
+    def fetch_rows(self, limit):
+        if not self.fetch_page_action.isEnabled():
+            return
+        if self.client.is_running(self.query_id):
+            self.status.showMessage('the query is still fetching rows', 5000)
+            return
+        self.set_fetch_enabled(False)
+        self.status.showMessage('fetching rows...')
+        self.fetch_pending = True
+        self.client.fetch(self.query_id, limit)
+        if self.client.is_running(self.query_id):
+            self.timings.start(self.query_id, 'fetch')
+
+    def set_fetch_enabled(self, enabled):
+        self.fetch_page_action.setEnabled(enabled)
+        self.fetch_all_action.setEnabled(enabled)
 
     def administration_views(self):
         w = ViewsWindow()
@@ -268,48 +426,187 @@ class MainWindow(QMainWindow):
         w.exec_()
 
     def validate_query(self):
-        if self.client.executing_cmd:
-            self.status.showMessage('another command is executing', 5000)
-            return
-        self.start_spin()
+        # a validation can run while a query is executing
+        if self.validation_id is not None and self.client.is_running(self.validation_id):
+            self.client.cancel(self.validation_id)
+            self.stop_spin(self.validation_id)
         query = self.editor.text()
-        self.client.validate(query)
-
-    def query_done(self, tipe, data):
-        self.stop_spin()
-        if tipe['type'] == 'collection' and data is not None:
-            data_array = []
+        self.validation_id = self.client.validate(query, cache_key=self.editor.normalized_text())
+        if self.client.is_running(self.validation_id):
+            self.timings.start(self.validation_id, 'validate', query)
+        if self.client.is_running(self.validation_id) and not self.client.is_cached(self.validation_id):
+            self.start_spin(self.validation_id)
+
+    @traced()
+    def query_done(self, cmd_id, tipe, data):
+        # the rows of a collection are added to the view as they are fetched
+        if cmd_id != self.query_id:
+            return
+        self.stop_spin(cmd_id)
+        self.rows_shown = 0
+        self.timings.expect(cmd_id, 'paint')
+        start = perf_counter()
+        self.query_results.show_data(tipe, data)
+        self.paint_start = perf_counter()
+        self.timings.add(cmd_id, 'model_build', self.paint_start - start)
+        if self.client.is_cached(cmd_id):
+            self.status.showMessage('result from the cache', 10000)
+        elif tipe['type'] == 'collection' and data is not None:
+            self.status.showMessage('fetching rows...')
+
+    @traced()
+    def rows_fetched(self, cmd_id, rows):
+        if cmd_id != self.query_id:
+            return
+        self.rows_shown += len(rows)
+        start = perf_counter()
+        self.query_results.append_rows(rows)
+        self.timings.add(cmd_id, 'model_build', perf_counter() - start)
+
+    def results_painted(self):
+        record = self.timings.done(self.query_id, 'paint', dict(paint=perf_counter() - self.paint_start))
+        if record is not None:
+            self.show_timing(record)
+
+    def command_timing(self, cmd_id, timing):
+        record = self.timings.done(cmd_id, 'worker', timing)
+        if record is not None:
+            self.show_timing(record)
+
+    def show_timing(self, record):
+        # only the timings of the commands started from the menus are shown
+        if record['id'] in [self.query_id, self.validation_id]:
+            self.timing_label.setText(self.timings.summary(record))
+
+    def toggle_trace(self, checked):
+        if checked:
+            path, _ = QFileDialog.getSaveFileName(self, "Save trace", "trace.json", "Trace files (*.json)")
+            if not path:
+                self.trace_action.setChecked(False)
+                return
+            tracer.enable(path)
+            self.status.showMessage('recording trace to %s' % path, 5000)
+        else:
             try:
-                for n in range(100):
-                    data_array.append(data.next())
-                self.status.showMessage('showing only 100 lines', 10000)
-            except StopIteration:
-                pass
-            data.close()
-            self.query_results.show_data(tipe, data_array)
+                path = tracer.disable()
+            except Exception as e:
+                self.dialog_critical(str(e))
+            else:
+                self.status.showMessage('trace saved to %s' % path, 10000)
+
+    def interface_stalled(self, seconds):
+        self.status.showMessage('the interface was blocked for %d ms (Settings > Stall report...)' % (seconds * 1000),
+                                5000)
+
+    def save_stall_report(self):
+        path, _ = QFileDialog.getSaveFileName(self, "Stall report", "", "Text files (*.txt);;All files (*.*)")
+        if not path:
+            return
+        try:
+            with open(path, 'w') as f:
+                f.write(self.stall_watchdog.report())
+        except Exception as e:
+            self.dialog_critical(str(e))
+
+    def export_timings(self):
+        path, _ = QFileDialog.getSaveFileName(self, "Export timings", "", "JSON lines (*.jsonl);;All files (*.*)")
+        if not path:
+            return
+        try:
+            self.timings.export(path)
+        except Exception as e:
+            self.dialog_critical(str(e))
+
+    def fetch_finished(self, cmd_id, more):
+        if cmd_id != self.query_id:
+            return
+        self.fetch_pending = False
+        self.set_fetch_enabled(more)
+        if more:
+            self.status.showMessage('showing %d lines, there can be more (Query > Fetch next page)' % self.rows_shown)
+        elif self.client.is_cached(cmd_id):
+            self.status.showMessage('%d lines from the cache (Query > Run query (bypass cache) to run it again)' %
+                                    self.rows_shown, 10000)
         else:
-            self.query_results.show_data(tipe, data)
+            self.status.showMessage('%d lines' % self.rows_shown, 10000)
 
-    def query_error(self, msg):
-        self.stop_spin()
+    def cursor_closed(self, cmd_id):
+        if cmd_id != self.query_id:
+            return
+        self.set_fetch_enabled(False)
+        self.status.showMessage('the result was closed after %d seconds without fetching rows' %
+                                self.cursor_idle_timeout, 10000)
+
+    def query_error(self, cmd_id, msg):
+        if cmd_id not in [self.query_id, self.validation_id]:
+            return
+        if cmd_id == self.query_id:
+            self.fetch_pending = False
+        self.stop_spin(cmd_id)
         self.query_results.show_error_text(msg)
 
-    def query_validated(self, data):
-        self.stop_spin()
+    def command_rejected(self, cmd_id, msg):
+        self.stop_spin(cmd_id)
+        if cmd_id == self.query_id and self.fetch_pending:
+            # the result is still open, the page can be asked again
+            self.fetch_pending = False
+            self.set_fetch_enabled(True)
+        self.status.showMessage(msg, 10000)
+
+    def live_validate(self, revision):
+        # Validates the text in the background when the typing stops, the previous validation is not
+        # needed anymore: it is cancelled if it is still queued, else its answer (cached) is dropped
+        if self.live_validation_id is not None:
+            self.client.cancel(self.live_validation_id, queued_only=True)
+        self.live_validation_id = None
+        if not self.editor.text().strip():
+            self.editor.clear_validation_errors()
+            return
+        self.live_validation_revision = revision
+        self.live_validation_id = self.client.validate(self.editor.text(), cache_key=self.editor.normalized_text())
+        if self.client.is_running(self.live_validation_id):
+            self.timings.start(self.live_validation_id, 'validate')
+
+    def query_validated(self, cmd_id, data):
+        if cmd_id == self.live_validation_id:
+            # the errors of an older text are dropped
+            if self.live_validation_revision == self.editor.revision:
+                self.editor.show_validation_errors(data['errors'])
+            return
+        if cmd_id != self.validation_id:
+            return
+        self.stop_spin(cmd_id)
+        self.editor.show_validation_errors(data['errors'])
         if data['errors']:
             self.query_results.show_error_text(str(data['errors']))
         else:
             self.query_results.show_text(data['type'])
 
     def stop_query(self):
-        if self.client.executing_cmd:
-            self.client.stop()
-            self.client.setParent(None)
-            # If the client is busy executing something then tries kill it create a new instance
-            self.init_client()
+        for cmd_id in [self.query_id, self.validation_id]:
+            if cmd_id is not None and self.client.is_running(cmd_id):
+                self.client.cancel(cmd_id)
+                self.status.showMessage('cancelling...')
 
         self.stop_spin()
 
+    def query_cancelled(self, cmd_id):
+        if cmd_id == self.validation_id:
+            self.stop_spin(cmd_id)
+            return
+        if cmd_id != self.query_id:
+            return
+        self.stop_spin(cmd_id)
+        self.fetch_pending = False
+        self.set_fetch_enabled(False)
+        self.status.showMessage('cancelled', 5000)
+
+    def closeEvent(self, event):
+        self.client.stop()
+        if self.stall_watchdog is not None:
+            self.stall_watchdog.stop()
+        super(MainWindow, self).closeEvent(event)
+
     def dialog_critical(self, s):
         dlg = QMessageBox(self)
         dlg.setText(s)
@@ -376,7 +673,9 @@ def get_config():
         # opening default theme
         with open(conf_file_path) as f:
             conf = json.load(f)
-        return dict(theme=load_theme(conf['theme']))
+        # the other keys are passed as they are, MainWindow has their defaults
+        conf['theme'] = load_theme(conf['theme'])
+        return conf
     else:
         return None
 
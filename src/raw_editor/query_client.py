@@ -1,56 +1,487 @@
 from PyQt5.QtCore import *
 
-from rawapi import new_raw_client, RawException
+from rawapi import new_raw_client
+from tracing import tracer, traced
+import hashlib
+import itertools
+import sys
 import threading
-from queue import Queue
+import time
+from collections import OrderedDict
+from queue import Queue, Empty, Full
+
+
+class QueryCancelled(Exception):
+    pass
+
+
+def result_size(obj):
+    # Approximate memory used by a result (dicts, lists and primitives)
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(result_size(value) for value in obj.values())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(result_size(value) for value in obj)
+    return size
+
+
+class QueryResultCache(object):
+    # LRU cache of complete query results, entries expire after 'ttl' seconds and the least
+    # recently used ones are removed when the results take more than 'max_bytes'
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        # key -> (value, size, time)
+        self.entries = OrderedDict()
+        # used from the GUI thread and the workers
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, size, t = entry
+            if time.perf_counter() - t > self.ttl:
+                del self.entries[key]
+                self.size -= size
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = (value, size, time.perf_counter())
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, old_size, _) = self.entries.popitem(last=False)
+                self.size -= old_size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
 
 class AsyncQueryClient(QObject):
+    # Commands are executed by a pool of worker threads, each one with its own client.
+    # Every command has an id and the signals carry the id of the command they answer
+    WORKERS = 2
+    # commands waiting for a free worker, more commands are rejected
+    QUEUE_SIZE = 16
+    # The rows of a collection are sent every BATCH_SIZE rows or every BATCH_INTERVAL seconds
+    BATCH_SIZE = 500
+    BATCH_INTERVAL = 0.1
+    # A result with more rows is kept open for the next pages, it is closed after this idle time (seconds)
+    CURSOR_IDLE_TIMEOUT = 300
+    # Complete results are kept in memory (up to CACHE_SIZE bytes, for CACHE_TTL seconds) to show them
+    # again without running the query
+    CACHE_SIZE = 64 * 1024 * 1024
+    CACHE_TTL = 300
+    # validations are cached by a hash of the normalized query
+    VALIDATION_CACHE_SIZE = 4 * 1024 * 1024
 
-    query_done = pyqtSignal(object, object)
-    query_validated = pyqtSignal(object)
-    error = pyqtSignal(str)
+    # For collections the data is an empty list, the rows come with rows_fetched
+    query_done = pyqtSignal(int, object, object)
+    rows_fetched = pyqtSignal(int, object)
+    # emitted after the last rows, True if the result is kept open to fetch more rows
+    fetch_finished = pyqtSignal(int, bool)
+    # the open result was closed because no more rows were fetched for a while
+    cursor_closed = pyqtSignal(int)
+    query_validated = pyqtSignal(int, object)
+    error = pyqtSignal(int, str)
+    # the command was cancelled and its result closed
+    cancelled = pyqtSignal(int)
+    # the command was not queued, all the workers are busy and the queue is full
+    rejected = pyqtSignal(int, str)
+    # timings (seconds) of a finished command, emitted after all its other signals
+    timing = pyqtSignal(int, object)
 
-    def __init__(self, parent = None):
+    def __init__(self, parent = None, workers=WORKERS, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE,
+                 batch_interval=BATCH_INTERVAL, cursor_idle_timeout=CURSOR_IDLE_TIMEOUT,
+                 cache_size=CACHE_SIZE, cache_ttl=CACHE_TTL):
         super(AsyncQueryClient, self).__init__(parent)
-        self.client = new_raw_client()
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.cursor_idle_timeout = cursor_idle_timeout
+        self.result_cache = QueryResultCache(cache_size, cache_ttl)
+        self.validation_cache = QueryResultCache(self.VALIDATION_CACHE_SIZE, cache_ttl)
+        # queries being answered from the cache
+        self.cached_answers = set()
+        # validations sent to the server by hash of the query, identical validations join them
+        self.validations = dict()
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        # commands queued or being executed by id
+        self.commands = dict()
+        # open results waiting for the next fetch (iterator, time of the last fetch, result to cache) by query id
+        self.cursors = dict()
         self.run = True
-        self.queue = Queue()
-        self.thread = threading.Thread(name='Async query', target=self.loop, daemon=True)
-        self.thread.start()
-        self.executing_cmd = False
+        self.queue = Queue(queue_size)
+        self.threads = []
+        for n in range(workers):
+            thread = threading.Thread(name='Async query %d' % n, target=self.loop, daemon=True)
+            thread.start()
+            self.threads.append(thread)
 
     def loop(self):
+        # the client is created for the first command that needs it
+        client = None
         while self.run:
-            cmd = self.queue.get()
-            self.executing_cmd = True
             try:
-                if cmd['action'] == 'query':
-                    data, tipe = self.client.query(cmd['query'], with_type=True)
-                    self.query_done.emit(tipe, data)
-                elif cmd['action'] == 'validate':
-                    data = self.client.query_validate(cmd['query'])
-                    print(data)
-                    self.query_validated.emit(data)
+                cmd = self.queue.get(timeout=self.cursor_timeout())
+            except Empty:
+                # nobody asked for more rows, the results are closed to free the server
+                self.close_idle_cursors()
+                continue
+            if cmd is None:
+                # stop() was called
+                break
+            cmd['started'] = time.perf_counter()
+            try:
+                with tracer.span('AsyncQueryClient.%s' % cmd['action'], id=cmd['id']):
+                    # fetch and close use the open result, not the client
+                    if client is None and cmd['action'] in ['query', 'validate']:
+                        client = self.connect(cmd)
+                    if client is not None or cmd['action'] not in ['query', 'validate']:
+                        cmd['client'] = client
+                        self.execute(cmd, client)
+            finally:
+                with self.lock:
+                    self.commands.pop(cmd['id'], None)
+                    for cmd_id in cmd['ids']:
+                        self.commands.pop(cmd_id, None)
+                    if self.validations.get(cmd.get('validation_key')) is cmd:
+                        del self.validations[cmd['validation_key']]
+                    ids = list(cmd['ids'])
+                timing = self.command_timing(cmd)
+                for cmd_id in ids:
+                    self.timing.emit(cmd_id, timing)
+            if cmd.get('client_closed'):
+                # the connection was closed to cancel the command, the next command uses a new client
+                client = None
+
+    def connect(self, cmd):
+        # Returns a new client, or None if it can not be created (the command fails with the error)
+        try:
+            return new_raw_client()
+        except Exception as e:
+            cmd['status'] = 'error'
+            self.answer(cmd, self.error, 'could not connect to the server: %s' % e)
+            return None
+
+    def execute(self, cmd, client):
+        cmd_id = cmd['id']
+        cancel = cmd['cancel']
+        try:
+            if cancel.is_set():
+                raise QueryCancelled()
+            if cmd['action'] == 'query':
+                data, tipe = client.query(cmd['query'], with_type=True)
+                cmd['answered'] = time.perf_counter()
+                if tipe['type'] == 'collection' and data is not None:
+                    # the result is read through the connection of the client
+                    cmd['cursor'] = data
+                    cmd['owner'] = client
+                    if cancel.is_set():
+                        raise QueryCancelled()
+                    # the rows are read here, so the GUI thread does not wait for the server
+                    self.query_done.emit(cmd_id, tipe, [])
+                    if cmd['cache_key'] is not None:
+                        # the rows are collected to cache the result once it is complete: key, type, rows, size
+                        cmd['cache'] = [cmd['cache_key'], tipe, [], 0]
+                    self.fetch_rows(cmd, cmd['limit'])
+                else:
+                    if cancel.is_set():
+                        raise QueryCancelled()
+                    self.query_done.emit(cmd_id, tipe, data)
+                    if cmd['cache_key'] is not None:
+                        self.result_cache.put(cmd['cache_key'], (tipe, data), result_size(data))
+            elif cmd['action'] == 'fetch':
+                with self.lock:
+                    cursor = self.cursors.pop(cmd_id, None)
+                if cursor is None:
+                    self.error.emit(cmd_id, 'the result was closed, run the query again')
                 else:
-                    raise Exception('Unexpected command %s' % cmd)
-            except RawException as e:
-                self.error.emit(str(e))
-            except ConnectionError as e:
-                self.error.emit(str(e))
-            except Exception as e:
-                print(e)
-                raise e
-            self.executing_cmd = False
-
-    def query(self, query):
-        cmd = dict(action='query', query=query)
-        # If the queue does not have slot it will raise an Exception
-        self.queue.put(cmd, block=False)
-
-    def validate(self, query):
-        cmd = dict(action='validate', query=query)
-        # If the queue does not have slot it will raise an Exception
-        self.queue.put(cmd, block=False)
+                    cmd['cursor'], _, cmd['cache'], cmd['owner'] = cursor
+                    self.fetch_rows(cmd, cmd['limit'])
+            elif cmd['action'] == 'close':
+                with self.lock:
+                    cursor = self.cursors.pop(cmd_id, None)
+                if cursor is not None:
+                    cursor[0].close()
+            elif cmd['action'] == 'validate':
+                data = client.query_validate(cmd['query'])
+                cmd['answered'] = time.perf_counter()
+                if cancel.is_set():
+                    raise QueryCancelled()
+                if cmd['validation_key'] is not None:
+                    self.validation_cache.put(cmd['validation_key'], data, result_size(data))
+                self.answer(cmd, self.query_validated, data)
+            else:
+                raise Exception('Unexpected command %s' % cmd)
+        except QueryCancelled:
+            self.close_cursor(cmd)
+            cmd['status'] = 'cancelled'
+            self.answer(cmd, self.cancelled)
+        except Exception as e:
+            # closing the connection (or the result) to cancel a request makes it fail
+            self.close_cursor(cmd)
+            if cancel.is_set():
+                cmd['status'] = 'cancelled'
+                self.answer(cmd, self.cancelled)
+            else:
+                cmd['status'] = 'error'
+                self.answer(cmd, self.error, str(e))
+
+    def command_timing(self, cmd):
+        # queue_wait: in the queue, server: until the server answered (time to first byte),
+        # first_row: from the answer to the first row, fetch: reading the rows
+        started = cmd['started']
+        timing = dict(action=cmd['action'], status=cmd.get('status', 'done'), cached=False,
+                      queue_wait=started - cmd['submitted'], worker=time.perf_counter() - started)
+        answered = cmd.get('answered')
+        if answered is not None:
+            timing['server'] = answered - started
+        if cmd.get('first_row') is not None:
+            timing['first_row'] = cmd['first_row'] - (answered or started)
+        if cmd.get('fetched') is not None:
+            timing['fetch'] = cmd['fetched'] - (answered or started)
+            timing['rows'] = cmd['rows']
+        return timing
+
+    def answer(self, cmd, signal, *args):
+        # Emits the signal for the command and for the identical validations that joined it
+        with self.lock:
+            if self.validations.get(cmd.get('validation_key')) is cmd:
+                # the next identical validations are answered by the cache or a new request
+                del self.validations[cmd['validation_key']]
+            ids = list(cmd['ids'])
+        for cmd_id in ids:
+            signal.emit(cmd_id, *args)
+
+    @traced()
+    def fetch_rows(self, cmd, limit):
+        # Reads up to 'limit' rows (all if None) from the result of the command and sends them in batches,
+        # the result is kept open while it can have more rows. The cancel event is checked between rows
+        data = cmd['cursor']
+        cancel = cmd['cancel']
+        rows = []
+        count = 0
+        last_batch = time.perf_counter()
+        more = False
+        try:
+            while limit is None or count < limit:
+                if cancel.is_set():
+                    rows = []
+                    raise QueryCancelled()
+                rows.append(data.next())
+                count += 1
+                now = time.perf_counter()
+                if count == 1 and cmd.get('first_row') is None:
+                    cmd['first_row'] = now
+                # the first row is sent as soon as it is read, the server can take a while for the next ones
+                if count == 1 or len(rows) >= self.batch_size or now - last_batch >= self.batch_interval:
+                    self.send_rows(cmd, rows)
+                    rows = []
+                    last_batch = now
+            more = True
+        except StopIteration:
+            pass
+        finally:
+            if rows:
+                self.send_rows(cmd, rows)
+            if more:
+                with self.lock:
+                    self.cursors[cmd['id']] = (data, time.perf_counter(), cmd.get('cache'), cmd.get('owner'))
+                cmd['cursor'] = None
+            else:
+                self.close_cursor(cmd)
+        cmd['fetched'] = time.perf_counter()
+        cmd['rows'] = count
+        if not more and cmd.get('cache') is not None:
+            key, tipe, all_rows, size = cmd['cache']
+            self.result_cache.put(key, (tipe, all_rows), size)
+        self.fetch_finished.emit(cmd['id'], more)
+
+    def send_rows(self, cmd, rows):
+        cache = cmd.get('cache')
+        if cache is not None:
+            cache[3] += result_size(rows)
+            if cache[3] > self.result_cache.max_bytes:
+                # too big to be cached, the rows collected are dropped
+                cmd['cache'] = None
+            else:
+                cache[2].extend(rows)
+        self.rows_fetched.emit(cmd['id'], rows)
+
+    def close_cursor(self, cmd):
+        data = cmd.get('cursor')
+        if data is not None:
+            cmd['cursor'] = None
+            data.close()
+
+    def cursor_timeout(self):
+        # Seconds until the oldest open result has to be closed, None if there are no open results
+        with self.lock:
+            if not self.cursors:
+                return None
+            oldest = min(cursor[1] for cursor in self.cursors.values())
+        return max(oldest + self.cursor_idle_timeout - time.perf_counter(), 0)
+
+    def close_idle_cursors(self):
+        now = time.perf_counter()
+        with self.lock:
+            idle = [cmd_id for cmd_id, cursor in self.cursors.items()
+                    if now - cursor[1] >= self.cursor_idle_timeout]
+            cursors = [(cmd_id, self.cursors.pop(cmd_id)[0]) for cmd_id in idle]
+        for cmd_id, data in cursors:
+            data.close()
+            self.cursor_closed.emit(cmd_id)
+
+    def submit(self, cmd):
+        # Queues the command and returns its id, rejected is emitted if the queue is full
+        cmd.setdefault('ids', [cmd['id']])
+        cmd['submitted'] = time.perf_counter()
+        with self.lock:
+            self.commands[cmd['id']] = cmd
+            if cmd.get('validation_key') is not None:
+                self.validations[cmd['validation_key']] = cmd
+        try:
+            self.queue.put(cmd, block=False)
+        except Full:
+            with self.lock:
+                self.commands.pop(cmd['id'], None)
+                if self.validations.get(cmd.get('validation_key')) is cmd:
+                    del self.validations[cmd['validation_key']]
+            self.rejected.emit(cmd['id'], 'too many commands waiting (%d), try again later' % self.queue.maxsize)
+        return cmd['id']
+
+    def is_running(self, cmd_id):
+        # True if the command is queued or being executed (or answered from the cache)
+        with self.lock:
+            return cmd_id in self.commands or cmd_id in self.cached_answers
+
+    def query(self, query, limit=None, cache_key=None, use_cache=True):
+        # cache_key identifies the query in the results cache (the normalized query text), the result
+        # is taken from the cache if use_cache is True and it is stored there when it is complete
+        cmd_id = next(self.ids)
+        if cache_key is not None and use_cache:
+            result = self.result_cache.get(cache_key)
+            if result is not None:
+                # answered from the GUI thread, after the caller got the id
+                self.cached_answers.add(cmd_id)
+                QTimer.singleShot(0, lambda: self.send_cached(cmd_id, result))
+                return cmd_id
+        cmd = dict(id=cmd_id, action='query', query=query, limit=limit, cache_key=cache_key,
+                   cancel=threading.Event())
+        return self.submit(cmd)
+
+    def send_cached(self, cmd_id, result):
+        tipe, data = result
+        if tipe['type'] == 'collection' and data is not None:
+            self.query_done.emit(cmd_id, tipe, [])
+            self.rows_fetched.emit(cmd_id, list(data))
+            self.fetch_finished.emit(cmd_id, False)
+        else:
+            self.query_done.emit(cmd_id, tipe, data)
+        self.cached_answers.discard(cmd_id)
+        self.timing.emit(cmd_id, dict(action='query', status='done', cached=True, queue_wait=0,
+                                      rows=len(data) if tipe['type'] == 'collection' and data is not None else 0))
+
+    def is_cached(self, cmd_id):
+        # True while the answer of the query comes from the results cache
+        return cmd_id in self.cached_answers
+
+    def fetch(self, query_id, limit=None):
+        # More rows (all if limit is None) of the result of a query, the signals carry the id of the query
+        cmd = dict(id=query_id, action='fetch', limit=limit, cancel=threading.Event())
+        return self.submit(cmd)
+
+    def close_result(self, query_id):
+        # Closes the result of a query kept open for more rows
+        cmd = dict(id=query_id, action='close', cancel=threading.Event())
+        return self.submit(cmd)
+
+    def validate(self, query, cache_key=None):
+        # cache_key is the normalized query, the validations of the same query are answered from the cache
+        # or share the request already sent to the server
+        cmd_id = next(self.ids)
+        key = None
+        if cache_key is not None:
+            key = hashlib.sha1(cache_key).hexdigest()
+            data = self.validation_cache.get(key)
+            if data is not None:
+                self.cached_answers.add(cmd_id)
+                QTimer.singleShot(0, lambda: self.send_cached_validation(cmd_id, data))
+                return cmd_id
+            with self.lock:
+                cmd = self.validations.get(key)
+                if cmd is not None and not cmd['cancel'].is_set():
+                    cmd['ids'].append(cmd_id)
+                    self.commands[cmd_id] = cmd
+                    return cmd_id
+        cmd = dict(id=cmd_id, action='validate', query=query, validation_key=key, cancel=threading.Event())
+        return self.submit(cmd)
+
+    def send_cached_validation(self, cmd_id, data):
+        self.query_validated.emit(cmd_id, data)
+        self.cached_answers.discard(cmd_id)
+        self.timing.emit(cmd_id, dict(action='validate', status='done', cached=True, queue_wait=0))
+
+    def cancel(self, cmd_id, queued_only=False):
+        # Cancels a command: the worker thread stops reading rows, closes the result and emits cancelled.
+        # The result being read is closed. A request blocked on the server is cut closing the connection
+        # of the client of its worker (when it supports it) unless that client has results open for
+        # the next pages, the worker uses a new client for the next commands.
+        # With queued_only a command that a worker started is not cancelled
+        close = None
+        with self.lock:
+            cmd = self.commands.get(cmd_id)
+            if cmd is None or (queued_only and 'started' in cmd):
+                return
+            shared = len(cmd['ids']) > 1
+            if shared:
+                # other validations wait for the same request, only this one is cancelled
+                cmd['ids'].remove(cmd_id)
+                del self.commands[cmd_id]
+            else:
+                cmd['cancel'].set()
+                if self.validations.get(cmd.get('validation_key')) is cmd:
+                    # the next identical validations do not join a cancelled one
+                    del self.validations[cmd['validation_key']]
+                if cmd.get('cursor') is not None:
+                    close = cmd['cursor'].close
+                elif cmd['action'] in ['query', 'validate'] and cmd.get('answered') is None:
+                    client = cmd.get('client')
+                    # results of the client kept for the next pages or being read by other workers
+                    owners = [cursor[3] for cursor in self.cursors.values()]
+                    owners += [other.get('owner') for other in self.commands.values() if other.get('cursor')]
+                    if not any(owner is client for owner in owners):
+                        close = getattr(client, 'close', None)
+                        cmd['client_closed'] = close is not None
+        # closing can wait for the server, the lock is not held
+        if close is not None:
+            close()
+        if shared:
+            self.cancelled.emit(cmd_id)
 
     def stop(self):
+        # The worker threads exit after their current command, the queued ones are cancelled
         self.run = False
+        with self.lock:
+            ids = list(self.commands)
+        for cmd_id in ids:
+            self.cancel(cmd_id)
+        for thread in self.threads:
+            try:
+                self.queue.put(None, block=False)
+            except Full:
+                # the workers are busy, they exit after their commands
+                pass
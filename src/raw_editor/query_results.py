@@ -1,9 +1,12 @@
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
-from PyQt5.QtCore import QSize
+from PyQt5.QtCore import QSize, Qt, QAbstractTableModel, QAbstractItemModel, QModelIndex, QEvent, QTimer, pyqtSignal
 import sys
 import os
 
+from tracing import traced
+from result_store import ColumnarStore
+
 default_theme = {
     'NullColor': QColor("#7f7f7f"),
     'StringColor': QColor("#9a2200"),
@@ -18,18 +21,30 @@ default_theme = {
 }
 
 
-def get_type_brush(tipe, theme):
+def get_type_color(tipe):
+    # Name of the theme color of the values of a type
     if tipe['type'] == 'string':
-        return QBrush(theme['StringColor'])
+        return 'StringColor'
     elif tipe['type'] in ['date', 'time', 'timestamp', 'interval']:
-        return QBrush(theme['TemporalColor'])
+        return 'TemporalColor'
     elif tipe['type'] in ['int', 'long', 'short', 'byte', 'float', 'double', 'decimal']:
-        return QBrush(theme['NumericTypeColor'])
+        return 'NumericTypeColor'
     else:
-        return QBrush(theme['DefaultTypeColor'])
+        return 'DefaultTypeColor'
+
+
+def get_type_brush(tipe, theme):
+    return QBrush(theme[get_type_color(tipe)])
+
+
+def compile_columns(columns, theme):
+    # Walks the type of the columns once, returns the brush of every column
+    return tuple(get_type_brush(tipe, theme) for idn, tipe in columns)
 
 
 class QueryView(QWidget):
+    # the results shown with show_data were painted for the first time
+    painted = pyqtSignal()
 
     def __init__(self, theme=None, parent=None):
         super(QueryView, self).__init__(parent)
@@ -44,6 +59,8 @@ class QueryView(QWidget):
         self.setMinimumSize(200, 200)
         # widget to show query results (either tree-view or table-view)
         self.results = None
+        # viewport of the results until it is painted
+        self.paint_watch = None
 
         # text widget to show errors
         self.textbox = QPlainTextEdit(self)
@@ -52,10 +69,15 @@ class QueryView(QWidget):
         self.layout.addWidget(self.textbox)
 
     def clear_results(self):
+        # the viewport watched is deleted with the results
+        if self.paint_watch is not None:
+            self.paint_watch.removeEventFilter(self)
+            self.paint_watch = None
         if self.results:
             self.results.hide()
             self.results.setParent(None)
 
+    @traced()
     def show_data(self, tipe, data):
         self.textbox.hide()
         self.clear_results()
@@ -63,8 +85,26 @@ class QueryView(QWidget):
             self.results = QueryTableView(tipe, data, parent=self, theme=self.theme)
         else:
             self.results = QueryTreeView(tipe, data, parent=self, theme=self.theme)
-            self.results.tree.setColumnWidth(0, self.width() / 2)
+            self.results.tree.setColumnWidth(0, int(self.width() / 2))
         self.layout.addWidget(self.results)
+        self.watch_paint(self.results.viewport() if self.is_tabular(tipe) else self.results.tree.viewport())
+
+    def watch_paint(self, viewport):
+        self.paint_watch = viewport
+        viewport.installEventFilter(self)
+
+    def eventFilter(self, obj, event):
+        if obj is self.paint_watch and event.type() == QEvent.Paint:
+            obj.removeEventFilter(self)
+            self.paint_watch = None
+            # emitted once this paint event is handled
+            QTimer.singleShot(0, self.painted.emit)
+        return False
+
+    @traced()
+    def append_rows(self, rows):
+        # rows of a collection result shown with show_data, that come after the first ones
+        self.results.append_rows(rows)
 
     def show_text(self, text):
         self.clear_results()
@@ -112,7 +152,85 @@ class QueryView(QWidget):
             return False
 
 
-class QueryTableView(QTreeWidget):
+class QueryTableModel(QAbstractTableModel):
+    # Keeps the rows by column in a ColumnarStore, cells are formatted only when the view asks for them
+    def __init__(self, tipe, data, theme=None, parent=None):
+        super(QueryTableModel, self).__init__(parent)
+
+        if theme:
+            self.theme = theme
+        else:
+            self.theme = default_theme
+
+        self.header = self.get_header(tipe)
+        if tipe['type'] == 'collection':
+            self.tipe = tipe['inner']
+            rows = data if data is not None else []
+        else:
+            self.tipe = tipe
+            rows = [data]
+
+        if self.tipe['type'] == 'record':
+            self.columns = [(att['idn'], att['type']) for att in self.tipe['atts']]
+        else:
+            self.columns = [(None, self.tipe)]
+        self.rows = ColumnarStore(self.columns)
+        self.rows.append_rows(rows)
+        # brushes of the columns, created once for the result and used by all its pages
+        self.brushes = compile_columns(self.columns, self.theme)
+        self.null_brush = QBrush(self.theme['NullColor'])
+        self.accessors = self.rows.accessors()
+
+    def get_header(self, tipe):
+        if tipe['type'] == 'collection':
+            return self.get_header(tipe['inner'])
+        elif tipe['type'] == 'record':
+            return [att['idn'] for att in tipe['atts']]
+        else:
+            return [tipe['type']]
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.rows)
+
+    def append_rows(self, rows):
+        # Appends rows to a collection result that is still being fetched
+        if not rows:
+            return
+        first = len(self.rows)
+        self.beginInsertRows(QModelIndex(), first, first + len(rows) - 1)
+        self.rows.append_rows(rows)
+        # a column of the store can be replaced by a more general one
+        self.accessors = self.rows.accessors()
+        self.endInsertRows()
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.columns)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.header[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == Qt.DisplayRole:
+            column = index.column()
+            value = self.accessors[column](index.row())
+            return 'null' if value is None else str(value)
+        elif role == Qt.ForegroundRole:
+            column = index.column()
+            if self.accessors[column](index.row()) is None:
+                return self.null_brush
+            return self.brushes[column]
+        return None
+
+
+class QueryTableView(QTableView):
     def __init__(self, tipe, data, theme=None, parent=None, ):
         super(QueryTableView, self).__init__(parent)
 
@@ -124,45 +242,241 @@ class QueryTableView(QTreeWidget):
         font.setPointSize(14)
         self.setFont(font)
         self.setAlternatingRowColors(True)
+        self.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.setWordWrap(False)
+        self.verticalHeader().setVisible(False)
+        self.horizontalHeader().setStretchLastSection(True)
+        # all the rows have the same height, so the view does not have to measure them
+        self.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.verticalHeader().setDefaultSectionSize(QFontMetrics(font).height() + 6)
+
+        self.table_model = QueryTableModel(tipe, data, theme=self.theme, parent=self)
+        self.setModel(self.table_model)
+
+    def append_rows(self, rows):
+        self.table_model.append_rows(rows)
+
+
+class QueryTreeNode(object):
+    # Node of the results tree, its children are only created when it is expanded.
+    # kind is 'field' (of a record), 'item' (of a collection), 'range' (of items of a big collection) or 'value'
+    def __init__(self, parent, row, kind, label, tipe, value, first=0, last=-1):
+        self.parent = parent
+        self.row = row
+        self.kind = kind
+        self.label = label
+        self.tipe = tipe
+        self.value = value
+        # items [first, last] of the collection in a range node
+        self.first = first
+        self.last = last
+        # items of the collection in every child of a range node (1 when the children are the items)
+        self.step = 1
+        self.children = None
+
+    def has_children(self):
+        if self.kind == 'range':
+            return True
+        elif self.value is None:
+            return False
+        elif self.tipe['type'] == 'record':
+            return len(self.tipe['atts']) > 0
+        elif self.tipe['type'] == 'collection':
+            return len(self.value) > 0
+        else:
+            return False
 
-        self.setHeaderLabels(self.get_header(tipe))
-        if tipe['type'] == 'collection' and data is not None:
-            for obj in data:
-                self.add_row(tipe['inner'], obj)
+    def child_step(self, range_size):
+        # Number of items of the collection in every child of this node
+        if self.kind == 'range':
+            return self.step
+        step = 1
+        while step * range_size < len(self.value):
+            step *= range_size
+        return step
+
+    def create_children(self, range_size):
+        if self.tipe['type'] == 'record':
+            return [QueryTreeNode(self, n, 'field', att['idn'], att['type'], self.value[att['idn']])
+                    for n, att in enumerate(self.tipe['atts'])]
+        elif self.kind == 'range':
+            return self.collection_children(self.first, self.last, range_size)
         else:
-            self.add_row(tipe, data)
+            return self.collection_children(0, len(self.value) - 1, range_size)
+
+    def collection_children(self, first, last, range_size):
+        # Children for the items [first, last] of the collection, added after the current children.
+        # Big collections are split in ranges, so no node has more than range_size children
+        row = len(self.children) if self.children else 0
+        step = self.child_step(range_size)
+        if step == 1:
+            inner = self.tipe['inner']
+            return [QueryTreeNode(self, row + n, 'item', '[%d]' % i, inner, self.value[i])
+                    for n, i in enumerate(range(first, last + 1))]
+
+        children = []
+        for n, i in enumerate(range(first, last + 1, step)):
+            node = QueryTreeNode(self, row + n, 'range', '', self.tipe, self.value, i, min(i + step - 1, last))
+            node.step = step // range_size
+            children.append(node)
+        return children
+
+
+class QueryTreeModel(QAbstractItemModel):
+    # Items of a big collection grouped in a single node
+    RANGE_SIZE = 1000
 
-    def add_row(self, tipe, data):
-        item = QTreeWidgetItem(self)
-        if data is None:
-            item.setForeground(0, QBrush(self.theme['NullColor']))
-            item.setText(0, 'null')
-            return
+    def __init__(self, tipe, data, theme=None, parent=None):
+        super(QueryTreeModel, self).__init__(parent)
 
-        if tipe['type'] == 'record':
-            row = [(data[att['idn']], att['type']) for att in tipe['atts']]
+        if theme:
+            self.theme = theme
         else:
-            row = [(str(data), tipe)]
-
-        for n, v in enumerate(row):
-            value = v[0]
-            tipe = v[1]
-            if value is None:
-                brush = QBrush(self.theme['NullColor'])
-                value = 'null'
-            else:
-                brush = get_type_brush(tipe, self.theme)
+            self.theme = default_theme
+        self.header = [tipe['type'], '']
+        # brushes by theme color name, created once
+        self.brushes = dict((name, QBrush(color)) for name, color in self.theme.items() if isinstance(color, QColor))
 
-            item.setForeground(n, brush)
-            item.setText(n, str(value))
+        if tipe['type'] in ['record', 'collection'] and data is not None:
+            # the fields or items of the result are the top level nodes
+            self.root = QueryTreeNode(None, 0, 'value', '', tipe, data)
+        else:
+            self.root = QueryTreeNode(None, 0, 'value', '', dict(type='root'), None)
+            self.root.children = [QueryTreeNode(self.root, 0, 'value', '', tipe, data)]
+
+    def node(self, index):
+        if index.isValid():
+            return index.internalPointer()
+        return self.root
+
+    def index(self, row, column, parent=QModelIndex()):
+        node = self.node(parent)
+        if node.children is None or row < 0 or row >= len(node.children):
+            return QModelIndex()
+        return self.createIndex(row, column, node.children[row])
+
+    def parent(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        node = index.internalPointer().parent
+        if node is None or node is self.root:
+            return QModelIndex()
+        return self.createIndex(node.row, 0, node)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.column() > 0:
+            return 0
+        node = self.node(parent)
+        return len(node.children) if node.children is not None else 0
+
+    def columnCount(self, parent=QModelIndex()):
+        return 2
+
+    def hasChildren(self, parent=QModelIndex()):
+        node = self.node(parent)
+        if node.children is not None:
+            return len(node.children) > 0
+        return node.has_children()
+
+    def canFetchMore(self, parent):
+        node = self.node(parent)
+        return node.children is None and node.has_children()
+
+    def fetchMore(self, parent):
+        node = self.node(parent)
+        if node.children is not None:
+            return
+        children = node.create_children(self.RANGE_SIZE)
+        self.beginInsertRows(parent, 0, len(children) - 1)
+        node.children = children
+        self.endInsertRows()
+
+    def append_rows(self, rows):
+        # Appends items to a collection result that is still being fetched
+        root = self.root
+        if not rows:
+            return
+        if root.children is None:
+            root.value.extend(rows)
+            self.fetchMore(QModelIndex())
+            return
 
-    def get_header(self, tipe):
-        if tipe['type'] == 'collection':
-            return self.get_header(tipe['inner'])
-        elif tipe['type'] == 'record':
-            return [att['idn'] for att in tipe['atts']]
+        first = len(root.value)
+        step = root.child_step(self.RANGE_SIZE)
+        root.value.extend(rows)
+        if root.child_step(self.RANGE_SIZE) != step:
+            # the items are grouped in bigger ranges, so the tree is built again
+            self.beginResetModel()
+            root.children = None
+            self.endResetModel()
+            self.fetchMore(QModelIndex())
         else:
-            return [tipe['type']]
+            self.extend_node(root, QModelIndex(), first, len(root.value) - 1)
+
+    def extend_node(self, node, index, first, last):
+        # The items [first, last] were appended to the collection of the node
+        if node.kind == 'range':
+            node.last = last
+        if node.children is None:
+            return
+
+        step = node.child_step(self.RANGE_SIZE)
+        if step > 1 and node.children:
+            # the last range is filled first
+            child = node.children[-1]
+            child_last = min(child.first + step - 1, last)
+            if child_last > child.last:
+                child_index = self.index(child.row, 0, index)
+                self.extend_node(child, child_index, child.last + 1, child_last)
+                self.dataChanged.emit(child_index, child_index)
+                first = child_last + 1
+
+        if first <= last:
+            children = node.collection_children(first, last, self.RANGE_SIZE)
+            row = len(node.children)
+            self.beginInsertRows(index, row, row + len(children) - 1)
+            node.children.extend(children)
+            self.endInsertRows()
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.header[section]
+        return None
+
+    def is_primitive(self, node):
+        return node.kind != 'range' and node.tipe['type'] not in ['record', 'collection']
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        node = index.internalPointer()
+        column = index.column()
+        if role == Qt.DisplayRole:
+            if column == 0:
+                if node.kind == 'range':
+                    return '[%d..%d]' % (node.first, node.last)
+                return node.label
+            elif node.kind == 'range':
+                return node.tipe['inner']['type']
+            elif node.value is None:
+                return 'null'
+            elif self.is_primitive(node):
+                return str(node.value)
+            else:
+                return node.tipe['type']
+        elif role == Qt.ForegroundRole:
+            if column == 0:
+                if node.kind == 'field':
+                    return self.brushes['RecordFieldColor']
+                return self.brushes['CollectionIndexColor']
+            elif node.kind != 'range' and node.value is None:
+                return self.brushes['NullColor']
+            elif self.is_primitive(node):
+                return self.brushes[get_type_color(node.tipe)]
+            elif node.kind == 'field':
+                return self.brushes['RecordInnerColor']
+            return self.brushes['CollectionInnerColor']
+        return None
 
 
 class QueryTreeView(QWidget):
@@ -182,7 +496,7 @@ class QueryTreeView(QWidget):
 
         toolbar = QToolBar("tree buttons")
         toolbar.setIconSize(QSize(24, 24))
-        self.tree = QTreeWidget(self)
+        self.tree = QTreeView(self)
         layout.addWidget(toolbar)
         layout.addWidget(self.tree)
 
@@ -197,39 +511,28 @@ class QueryTreeView(QWidget):
         toolbar.addAction(collapse_all)
 
         self.tree.setAlternatingRowColors(True)
-
-        self.tree.setHeaderLabels([tipe['type'], ''])
-        if tipe['type'] in ['record', 'collection', 'array'] and data is not None:
-            root = self.tree
-        else:
-            root = QTreeWidgetItem(self.tree)
-
-        self.add_items(root, tipe, data)
-        self.tree.expandAll()
-        self.tree.setColumnWidth(0, self.width() / 2)
-
-    def add_items(self, root, tipe, data):
-        if data is None:
-            root.setForeground(1, QBrush(self.theme['NullColor']))
-            root.setText(1, 'null')
-        elif tipe['type'] == 'record':
-            for att in tipe['atts']:
-                item = QTreeWidgetItem(root, [att['idn'], att['type']['type']])
-                item.setForeground(0, QBrush(self.theme['RecordFieldColor']))
-                item.setForeground(1, QBrush(self.theme['RecordInnerColor']))
-                self.add_items(item, att['type'], data[att['idn']])
-
-        elif tipe['type'] == 'collection':
-            inner = tipe['inner']
-            for n, obj in enumerate(data):
-                item = QTreeWidgetItem(root, ['[%d]' % n, inner['type']])
-                item.setForeground(0, QBrush(self.theme['CollectionIndexColor']))
-                item.setForeground(1, QBrush(self.theme['CollectionInnerColor']))
-                self.add_items(item, inner, obj)
-        else:
-            brush = get_type_brush(tipe, self.theme)
-            root.setForeground(1, brush)
-            root.setText(1, str(data))
+        self.tree.setUniformRowHeights(True)
+
+        # children are created when their parent is expanded,
+        # only the first level is expanded at start (but not the ranges of a big collection)
+        self.tree_model = QueryTreeModel(tipe, data, theme=self.theme, parent=self)
+        self.tree.setModel(self.tree_model)
+        if self.tree_model.canFetchMore(QModelIndex()):
+            self.tree_model.fetchMore(QModelIndex())
+        self.expand_rows(0)
+
+    def expand_rows(self, first):
+        for row in range(first, self.tree_model.rowCount()):
+            index = self.tree_model.index(row, 0)
+            if index.internalPointer().kind != 'range':
+                self.tree.expand(index)
+
+    def append_rows(self, rows):
+        count = self.tree_model.rowCount()
+        self.tree_model.append_rows(rows)
+        # the new items are expanded like the first ones (the tree was built again if there are less rows)
+        self.expand_rows(count if self.tree_model.rowCount() >= count else 0)
+        self.tree.setColumnWidth(0, int(self.width() / 2))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,79 @@
+import json
+import time
+from collections import OrderedDict, deque
+
+
+class QueryTimings(object):
+    """
+    Timings of the commands sent to the server, from the worker thread (queue wait, server, first row, fetch)
+    and from the GUI (model build, paint). A record is complete when all its parts arrived,
+    the last records are kept to be exported as JSON lines.
+    """
+    MAX_RECORDS = 1000
+    # records waiting for their parts, the oldest are completed as they are
+    MAX_PENDING = 100
+
+    def __init__(self):
+        self.pending = OrderedDict()
+        self.records = deque(maxlen=self.MAX_RECORDS)
+
+    def start(self, cmd_id, action, query=None):
+        # parts: 'worker' (the timing signal of the client) and 'paint' (when the command shows data)
+        record = dict(id=cmd_id, action=action, time=time.time(), start=time.perf_counter(), parts={'worker'})
+        if query is not None:
+            record['query'] = query[:200]
+        self.pending[cmd_id] = record
+        while len(self.pending) > self.MAX_PENDING:
+            self.finish(next(iter(self.pending)))
+
+    def add(self, cmd_id, name, seconds):
+        # Adds the seconds to the time of 'name' (the model is built in several batches)
+        record = self.pending.get(cmd_id)
+        if record is not None:
+            record[name] = record.get(name, 0) + seconds
+
+    def expect(self, cmd_id, part):
+        record = self.pending.get(cmd_id)
+        if record is not None:
+            record['parts'].add(part)
+
+    def done(self, cmd_id, part, values=None):
+        # One part of the record arrived, returns the record if it is complete
+        record = self.pending.get(cmd_id)
+        if record is None:
+            return None
+        if values:
+            record.update(values)
+        record['parts'].discard(part)
+        if record['parts']:
+            return None
+        return self.finish(cmd_id)
+
+    def finish(self, cmd_id):
+        # Completes the record with the parts that arrived
+        record = self.pending.pop(cmd_id, None)
+        if record is None:
+            return None
+        record['total'] = time.perf_counter() - record.pop('start')
+        del record['parts']
+        self.records.append(record)
+        return record
+
+    def summary(self, record):
+        # Compact text for the status bar
+        names = [('queue_wait', 'queue'), ('server', 'server'), ('first_row', 'first row'), ('fetch', 'fetch'),
+                 ('model_build', 'model'), ('paint', 'paint'), ('total', 'total')]
+        parts = ['%s %d ms' % (label, record[name] * 1000) for name, label in names if name in record]
+        text = '%s: %s' % (record['action'], ', '.join(parts))
+        if 'rows' in record:
+            text += ', %d rows' % record['rows']
+        if record.get('cached'):
+            text += ' (cache)'
+        if record.get('status', 'done') != 'done':
+            text += ' (%s)' % record['status']
+        return text
+
+    def export(self, path):
+        with open(path, 'w') as f:
+            for record in self.records:
+                f.write(json.dumps(record) + '\n')
@@ -0,0 +1,236 @@
+"""
+Columnar store of tabular results (collections of records of primitives): every column keeps its values
+in a compact array instead of one python dict per row.
+
+Numeric and bool columns are arrays of machine values of the size of their type (the integers of float
+columns are marked in a bitmap, so they are shown as they came), strings and temporal values are dictionary
+encoded (every distinct value is kept once and the rows keep its code in the smallest array that fits).
+Dictionary columns whose values are mostly distinct become packed UTF-8 strings with an array of offsets.
+Nulls are bits of a bitmap. Decimals, and the columns whose values do not fit their array (a long out of
+64 bits, a value of another type), are kept as plain lists.
+"""
+from array import array
+
+# array type code of the numeric types
+NUMERIC_TYPECODES = {
+    'byte': 'b',
+    'short': 'h',
+    'int': 'i',
+    'long': 'q',
+    'float': 'd',
+    'double': 'd',
+    'bool': 'b',
+}
+# integers of float columns bigger than this are not exact as doubles
+MAX_EXACT_INT = 2 ** 53
+# types of the dictionary encoded columns, their values are strings
+DICTIONARY_TYPES = ['string', 'date', 'time', 'timestamp', 'interval']
+# array type codes of the dictionary codes and the number of values they can code
+CODE_TYPECODES = [('B', 2 ** 8), ('H', 2 ** 16), ('I', 2 ** 32)]
+# from this many rows a dictionary column with more distinct values than MAX_DISTINCT_RATIO of its rows
+# is packed: a distinct value costs more in the dictionary (entry, list slot and code) than packed
+DICTIONARY_MIN_ROWS = 1000
+MAX_DISTINCT_RATIO = 0.5
+
+
+def set_bit(bitmap, row):
+    # Sets the bit of the row, returns the bitmap (a new one if it was None)
+    if bitmap is None:
+        bitmap = bytearray()
+    byte = row >> 3
+    if byte >= len(bitmap):
+        bitmap.extend(bytes(byte - len(bitmap) + 1))
+    bitmap[byte] |= 1 << (row & 7)
+    return bitmap
+
+
+def get_bit(bitmap, row):
+    byte = row >> 3
+    return bitmap is not None and byte < len(bitmap) and bool(bitmap[byte] & (1 << (row & 7)))
+
+
+class Column(object):
+    # Every column has a bitmap of its nulls, allocated with the first null
+    def __init__(self):
+        self.size = 0
+        self.nulls = None
+
+    def is_null(self, row):
+        return get_bit(self.nulls, row)
+
+    def null_positions(self, values):
+        # Marks the nulls of the values appended, returns True if there are any
+        if None not in values:
+            return False
+        for n, value in enumerate(values):
+            if value is None:
+                self.nulls = set_bit(self.nulls, self.size + n)
+        return True
+
+
+class NumericColumn(Column):
+    def __init__(self, typecode, is_bool=False):
+        super(NumericColumn, self).__init__()
+        self.values = array(typecode)
+        self.is_bool = is_bool
+        # bitmap of the integers of a float column, allocated with the first one
+        self.ints = None
+
+    def extend(self, values):
+        # Raises TypeError or OverflowError (and appends nothing) when a value does not fit the array
+        ints = None
+        if self.values.typecode == 'd':
+            ints = [n for n, value in enumerate(values) if type(value) is int]
+            if any(abs(values[n]) > MAX_EXACT_INT for n in ints):
+                raise OverflowError('integer too big for a double')
+        if self.null_positions(values):
+            values = [0 if value is None else value for value in values]
+        values = array(self.values.typecode, values)
+        for n in ints or ():
+            self.ints = set_bit(self.ints, self.size + n)
+        self.values.extend(values)
+        self.size += len(values)
+
+    def value(self, row):
+        if self.is_null(row):
+            return None
+        value = self.values[row]
+        if self.is_bool:
+            return bool(value)
+        elif self.ints is not None and get_bit(self.ints, row):
+            return int(value)
+        return value
+
+
+class DictionaryColumn(Column):
+    # The distinct values are kept once, the rows keep their position in self.dictionary
+    def __init__(self):
+        super(DictionaryColumn, self).__init__()
+        self.dictionary = []
+        self.codes = {}
+        self.values = array(CODE_TYPECODES[0][0])
+
+    def extend(self, values):
+        # Raises TypeError (and appends no rows) for values that can not be dictionary keys
+        codes = self.codes
+        dictionary = self.dictionary
+        new_codes = []
+        for value in values:
+            code = codes.get(value)
+            if code is None:
+                code = len(dictionary)
+                codes[value] = code
+                dictionary.append(value)
+            new_codes.append(code)
+        for typecode, count in CODE_TYPECODES:
+            if len(dictionary) <= count:
+                break
+        if typecode != self.values.typecode:
+            self.values = array(typecode, self.values)
+        self.null_positions(values)
+        self.values.extend(new_codes)
+        self.size += len(values)
+
+    def too_distinct(self):
+        return self.size >= DICTIONARY_MIN_ROWS and len(self.dictionary) > self.size * MAX_DISTINCT_RATIO
+
+    def value(self, row):
+        return self.dictionary[self.values[row]]
+
+
+class StringColumn(Column):
+    # The values encoded in UTF-8 one after the other, the value of a row ends at self.offsets[row + 1]
+    def __init__(self):
+        super(StringColumn, self).__init__()
+        self.data = bytearray()
+        self.offsets = array('I', [0])
+
+    def extend(self, values):
+        # Raises TypeError, ValueError or OverflowError (and appends nothing) for values that are not strings
+        encoded = [str.encode('' if value is None else value) for value in values]
+        offsets = array('I')
+        end = self.offsets[-1]
+        for data in encoded:
+            end += len(data)
+            offsets.append(end)
+        self.null_positions(values)
+        self.data.extend(b''.join(encoded))
+        self.offsets.extend(offsets)
+        self.size += len(values)
+
+    def value(self, row):
+        if self.is_null(row):
+            return None
+        return self.data[self.offsets[row]:self.offsets[row + 1]].decode()
+
+
+class ObjectColumn(Column):
+    # Plain list, for the columns that do not fit the others
+    def __init__(self, values=()):
+        super(ObjectColumn, self).__init__()
+        self.values = list(values)
+        self.size = len(self.values)
+
+    def extend(self, values):
+        self.values.extend(values)
+        self.size += len(values)
+
+    def value(self, row):
+        return self.values[row]
+
+
+def packed_column(column):
+    # StringColumn with the values of the column, an ObjectColumn if they are not all strings
+    values = [column.value(row) for row in range(column.size)]
+    strings = StringColumn()
+    try:
+        strings.extend(values)
+    except (TypeError, OverflowError, ValueError):
+        return ObjectColumn(values)
+    return strings
+
+
+def new_column(tipe):
+    typecode = NUMERIC_TYPECODES.get(tipe['type'])
+    if typecode is not None:
+        return NumericColumn(typecode, is_bool=tipe['type'] == 'bool')
+    elif tipe['type'] in DICTIONARY_TYPES:
+        return DictionaryColumn()
+    return ObjectColumn()
+
+
+class ColumnarStore(object):
+    """
+    Rows of a tabular result by column. 'columns' are the (field name, type) of the columns,
+    a None field name is a collection of primitives (the row is the value).
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.data = [new_column(tipe) for idn, tipe in columns]
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append_rows(self, rows):
+        for n, (idn, tipe) in enumerate(self.columns):
+            if idn is None:
+                values = rows
+            else:
+                values = [None if row is None else row.get(idn) for row in rows]
+            column = self.data[n]
+            try:
+                column.extend(values)
+            except (TypeError, OverflowError, ValueError):
+                # the column keeps the values as they are from now on
+                self.data[n] = ObjectColumn(column.value(row) for row in range(column.size))
+                self.data[n].extend(values)
+                continue
+            if isinstance(column, DictionaryColumn) and column.too_distinct():
+                self.data[n] = packed_column(column)
+        self.size += len(rows)
+
+    def accessors(self):
+        # Functions that return the value of a row of every column, valid until rows are appended
+        return tuple(column.value for column in self.data)
@@ -1,12 +1,17 @@
 from theme import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
+from PyQt5.QtCore import *
 from PyQt5.Qsci import QsciScintilla, QsciLexerCustom, QsciAPIs
+from rql_tokenizer import RqlTokenizer
+from tracing import traced
 
+import os
 import sys
-import re
-from multiprocessing import Process
-from time import sleep
+import hashlib
+import threading
+from queue import Queue
+from time import perf_counter
 
 default_theme = {
     "DefaultFont": QFont("Consolas", 12),
@@ -14,7 +19,6 @@ default_theme = {
     "DefaultPaperColor": QColor("#FFFFFFFF"),
     'MarginBackGroundColor': QColor('#cccccc'),
     'MarkerBackgroundColor': QColor("#ee1111"),
-    'CaretForegroundColor': [],
     'CaretLineBackgroundColor': QColor("#ffe4e4"),
     'MatchedBraceForegroundColor': QColor("#ff0000"),
     'MatchedBraceBackgroundColor': QColor("#ffffff"),
@@ -33,6 +37,9 @@ default_theme = {
 
 
 class RawLexer(QsciLexerCustom):
+    # States at the end of a line
+    DEFAULT = RqlTokenizer.DEFAULT
+    MULTILINE_STRING = RqlTokenizer.MULTILINE_STRING
 
     def __init__(self, theme=default_theme, parent=None):
         super(RawLexer, self).__init__(parent)
@@ -47,12 +54,14 @@ class RawLexer(QsciLexerCustom):
         # ----------------------------
         self.styles = dict()
         self.style_names = dict()
-        self.regexes = []
         # self.theme = theme
 
         for name, value in theme['styles'].items():
             self.add_style(name, value['color'], bold=value['bold'])
 
+        # the tokenizer does not depend on Qt, so it can also run outside the GUI thread
+        self.tokenizer = RqlTokenizer(self.styles['strings'])
+
         self.keywords = ['select', 'distinct', 'from', 'where', 'group', 'by', 'having', 'in',
                          'union', 'order', 'desc', 'asc', 'if', 'then', 'else', 'parse',
                          'parse?', 'into', 'not', 'and', 'or', 'flatten', 'like', 'as',
@@ -90,27 +99,24 @@ class RawLexer(QsciLexerCustom):
         self.add_match('parens', r"[\(\[\{\)\]\}]")
         self.add_match('strings', r'r?"(?:[^"\\]|\\.)*"')
 
-        # when nothing else matches takes the next token
-        self.next_token = re.compile(r'^\s+|\w+|\W')
-        # multiline string is handled differently
-        self.multiline_string = re.compile('^"""')
+        # Incremental styling
+        # --------------------
+        # The end-of-line state of every styled line is kept in the Scintilla line state
+        # (shifted by Scintilla itself when lines are added or removed).
+        # valid_end is the position up to which the styling is known to be valid and
+        # dirty_end the position where the edits made since the last styling end.
+        self.valid_end = 0
+        self.dirty_end = 0
 
     def add_match(self, style, obj, case_sensitive=False):
-        if isinstance(obj, str):
-            regex = obj
-        elif isinstance(obj, list):
-            regex = r'|'.join([r'\b' + r + r'\b' for r in obj])
+        style_number = self.styles[style]
+        if isinstance(obj, list):
+            self.tokenizer.add_words(obj, style_number, case_sensitive)
+        elif isinstance(obj, str):
+            self.tokenizer.add_regex(obj, style_number, case_sensitive)
         else:
             raise Exception('match can only be a string or a list of keywords')
 
-        # adds the ^ at the beginning to match only at the beginning of the string
-        if not case_sensitive:
-            r = re.compile("^" + regex, re.IGNORECASE)
-        else:
-            r = re.compile("^" + regex)
-        style_number = self.styles[style]
-        self.regexes.append((r, style_number))
-
     def add_style(self, name, color, paper=None, bold=False):
         count = len(self.styles)
         self.styles[name] = count
@@ -132,37 +138,210 @@ class RawLexer(QsciLexerCustom):
         else:
             return ""
 
+    def setEditor(self, editor):
+        super(RawLexer, self).setEditor(editor)
+        self.valid_end = 0
+        self.dirty_end = 0
+        if editor is not None:
+            editor.SCN_MODIFIED.connect(self.text_modified)
+
+    def text_modified(self, position, modification_type, text, length, *args):
+        # Keeps valid_end and dirty_end in sync with the edits of the document
+        if modification_type & QsciScintilla.SC_MOD_INSERTTEXT:
+            if position < self.valid_end:
+                self.valid_end += length
+            if self.dirty_end > position:
+                self.dirty_end += length
+            self.dirty_end = max(self.dirty_end, position + length)
+        elif modification_type & QsciScintilla.SC_MOD_DELETETEXT:
+            if position < self.valid_end:
+                self.valid_end = max(position, self.valid_end - length)
+            if self.dirty_end > position:
+                self.dirty_end = max(position, self.dirty_end - length)
+            self.dirty_end = max(self.dirty_end, position)
+
+    def normalize(self, text):
+        # The text without comments and with the blanks between tokens normalized
+        return self.tokenizer.normalize(text.encode(), [self.styles['comments']])
+
+    def line_state(self, line):
+        # Returns the state at the end of the line, the state before the first line is DEFAULT
+        if line < 0:
+            return self.DEFAULT
+        return self.editor().SendScintilla(QsciScintilla.SCI_GETLINESTATE, line) - 1
+
+    def text_range(self, start, end):
+        # Reads only the bytes between the positions start and end of the document (SCI_GETTEXTRANGE)
+        if end <= start:
+            return b''
+        return self.editor().bytes(start, end).data()[:end - start]
+
+    @traced()
     def styleText(self, start, end):
         # Called everytime the editors text has changed
-        # 1. Initialize the styling procedure
-        # ------------------------------------
+        # Styles whole lines starting at the line of 'start', and stops as soon as a line
+        # after the edited text ends in the same state as before (the rest is still valid).
+        # Positions are byte offsets in the (UTF-8) document and the text is styled as bytes
+        editor = self.editor()
+        line = editor.SendScintilla(QsciScintilla.SCI_LINEFROMPOSITION, start)
+        last_line = editor.SendScintilla(QsciScintilla.SCI_LINEFROMPOSITION, max(start, end - 1))
+
+        pos = editor.SendScintilla(QsciScintilla.SCI_POSITIONFROMLINE, line)
+        range_start = pos
+        range_end = self.line_end(last_line)
+        text = self.text_range(range_start, range_end)
+
+        # styles of the whole range, applied at once with SCI_SETSTYLINGEX
+        styles = bytearray(len(text))
+        state = self.line_state(line - 1)
+
+        while line <= last_line:
+            line_start = pos
+            pos = self.line_end(line)
+            state = self.tokenizer.style_line(text, line_start - range_start, pos - range_start, state, styles)
+
+            previous = self.line_state(line)
+            editor.SendScintilla(QsciScintilla.SCI_SETLINESTATE, line, state + 1)
+            line += 1
+
+            if line_start > self.dirty_end and previous == state and end <= self.valid_end:
+                # Same state as before after the edited text: the styling up to valid_end is still valid
+                self.set_styles(range_start, styles, pos - range_start)
+                self.startStyling(self.valid_end)
+                self.dirty_end = 0
+                return
+
+        self.set_styles(range_start, styles, pos - range_start)
+        self.valid_end = pos
+        if pos >= self.dirty_end:
+            self.dirty_end = 0
+
+    def set_styles(self, start, styles, length):
+        # Applies the first 'length' styles from the position start in a single call
         self.startStyling(start)
-
-        text = self.parent().text()[start:end]
-
-        # Tries a regex and if it matches applies the style and removes token from text
-        def try_match(regex, style):
-            nonlocal text
-            m = regex.match(text)
-            if m:
-                token = m.group(0)
-                self.setStyling(len(token), style)
-                text = text[len(token):]
-                return True
-            return False
-
-        while text:
-            for (regex, style) in self.regexes:
-                if try_match(regex, style):
-                    continue
-            # if noting matches sets the default style (0)
-            try_match(self.next_token, 0)
+        self.editor().SendScintilla(QsciScintilla.SCI_SETSTYLINGEX, length, bytes(styles[:length]))
+
+    def line_end(self, line):
+        # Position after the end of line of 'line'
+        editor = self.editor()
+        if line + 1 >= editor.lines():
+            return editor.length()
+        return editor.SendScintilla(QsciScintilla.SCI_POSITIONFROMLINE, line + 1)
+
+    def apply_tokenized(self, styles, line_states):
+        # Applies the result of tokenizing the whole document (RqlTokenizer.tokenize) in one step
+        editor = self.editor()
+        self.set_styles(0, styles, len(styles))
+        for line, state in enumerate(line_states):
+            editor.SendScintilla(QsciScintilla.SCI_SETLINESTATE, line, state + 1)
+        self.valid_end = len(styles)
+        self.dirty_end = 0
+
+
+class TokenizerWorker(QObject):
+    # Tokenizes snapshots of a document in a worker thread
+
+    # revision of the snapshot, styles and line states
+    tokenized = pyqtSignal(int, object, object)
+
+    def __init__(self, tokenizer, parent=None):
+        super(TokenizerWorker, self).__init__(parent)
+        self.tokenizer = tokenizer
+        self.queue = Queue()
+        self.thread = None
+
+    def loop(self):
+        while True:
+            revision, text = self.queue.get()
+            # only the most recent snapshot is worth tokenizing
+            while not self.queue.empty():
+                revision, text = self.queue.get()
+            styles, line_states = self.tokenizer.tokenize(text)
+            self.tokenized.emit(revision, styles, line_states)
+
+    def tokenize(self, revision, text):
+        # the thread is only started by the first document big enough to need it
+        if self.thread is None:
+            self.tokenizer.compile()
+            self.thread = threading.Thread(name='Tokenizer', target=self.loop, daemon=True)
+            self.thread.start()
+        self.queue.put((revision, text))
+
+
+# Prepared auto-complete apis (and the lexer that owns each of them) by hash of their words
+prepared_apis = dict()
+
+
+def api_cache_dir():
+    path = os.path.join(QStandardPaths.writableLocation(QStandardPaths.GenericCacheLocation), 'raw-editor')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def get_prepared_api(words):
+    # Returns an api with the words, prepared once per process and saved on disk for the next runs
+    key = hashlib.sha1('\n'.join(words).encode()).hexdigest()
+    if key in prepared_apis:
+        return prepared_apis[key][1]
+
+    # the api belongs to its own lexer, so it is not deleted with the editor that asked for it
+    lexer = RawLexer()
+    api = QsciAPIs(lexer)
+    try:
+        path = os.path.join(api_cache_dir(), 'rql-%s.pap' % key)
+    except OSError:
+        # the cache directory can not be created, the api is prepared without saving it
+        path = None
+    if path is None or not api.loadPrepared(path):
+        for s in words:
+            api.add(s)
+        if path is not None:
+            api.apiPreparationFinished.connect(lambda: api.savePrepared(path))
+        api.prepare()
+    prepared_apis[key] = (lexer, api)
+    return api
+
+
+def error_positions(error):
+    # Returns the ranges (line, index, end line, end index), starting at 0, of a validation error.
+    # The positions of the errors start at line 1 and column 1
+    positions = []
+    if not isinstance(error, dict):
+        return positions
+    for position in error.get('positions', []):
+        try:
+            begin, end = position['begin'], position['end']
+            positions.append((begin['line'] - 1, begin['column'] - 1, end['line'] - 1, end['column'] - 1))
+        except (KeyError, TypeError):
+            pass
+    return positions
 
 
 class RqlEditor(QsciScintilla):
     ARROW_MARKER_NUM = 8
-
-    def __init__(self, theme=default_theme, parent=None):
+    # Indicator (underline) of the validation errors
+    ERROR_INDICATOR_NUM = 8
+    # Milliseconds without changes before the query is validated in the background (0 to disable)
+    VALIDATION_DEBOUNCE = 700
+    # Milliseconds spent styling the rest of the document each time the event loop is idle
+    IDLE_STYLING_BUDGET = 20
+    # Lines styled at once by the idle styling
+    IDLE_STYLING_LINES = 500
+    # Milliseconds without typing that end a group of edits undone at once
+    UNDO_GROUP_TIMEOUT = 1000
+    # Documents that change by more than this many bytes at once are tokenized in a worker thread
+    BACKGROUND_STYLING_SIZE = 256 * 1024
+    # Bigger documents are not normalized to recognize the same query (it takes ~40 ms for 32 KB),
+    # their text is used as it is
+    NORMALIZE_SIZE = 32 * 1024
+
+    # percentage of the document that is styled
+    styling_progress = pyqtSignal(int)
+    # the text did not change for a while and can be validated, with the revision of the document
+    validation_requested = pyqtSignal(int)
+
+    def __init__(self, theme=default_theme, parent=None, idle_styling_budget=IDLE_STYLING_BUDGET,
+                 validation_debounce=VALIDATION_DEBOUNCE):
         super(RqlEditor, self).__init__(parent)
 
         if theme:
@@ -200,6 +379,9 @@ class RqlEditor(QsciScintilla):
                           self.ARROW_MARKER_NUM)
         self.setMarkerBackgroundColor(self.theme['MarkerBackgroundColor'],
                                       self.ARROW_MARKER_NUM)
+        # Validation errors are underlined and marked in the margin
+        self.indicatorDefine(QsciScintilla.SquiggleIndicator, self.ERROR_INDICATOR_NUM)
+        self.setIndicatorForegroundColor(self.theme['MarkerBackgroundColor'], self.ERROR_INDICATOR_NUM)
 
         # Brace matching: enable for a brace immediately before or after
         # the current position
@@ -212,6 +394,9 @@ class RqlEditor(QsciScintilla):
         if 'CaretForegroundColor' in theme:
             self.setCaretForegroundColor(self.theme['CaretForegroundColor'])
 
+        # The lexer styles the text as UTF-8 bytes
+        self.setUtf8(True)
+
         # Lexer for syntax highlighting
         self.lexer = RawLexer(theme=self.theme, parent=self)
         self.setLexer(self.lexer)
@@ -219,13 +404,9 @@ class RqlEditor(QsciScintilla):
         self.setAutoCompletionThreshold(3)
         self.setAutoCompletionSource(QsciScintilla.AcsAll)
 
-        # Create new api for auto-complete
-        self.api = QsciAPIs(self.lexer)
-        # adds all keywords
-        for s in self.lexer.keywords + self.lexer.constants + self.lexer.builtin_functions:
-            self.api.add(s)
-
-        self.api.prepare()
+        # Api for auto-complete with all the keywords, shared by all the editors
+        self.api = get_prepared_api(self.lexer.keywords + self.lexer.constants + self.lexer.builtin_functions)
+        self.lexer.setAPIs(self.api)
         # Don't want to see the horizontal scrollbar at all
         # Use raw message to Scintilla here (all messages are documented
         # here: http://www.scintilla.org/ScintillaDoc.html)
@@ -234,9 +415,36 @@ class RqlEditor(QsciScintilla):
         # not too small
         self.setMinimumSize(600, 450)
 
-        # thread to start stop the the undo collection (will save each 5 seconds)
-        self.undo_thread = Process(name='Undo thread', target=self.undo_loop, daemon=True)
-        self.undo_thread.start()
+        # Scintilla only styles the visible lines, the rest of the document is styled
+        # in time slices whenever the event loop is idle (a timer with interval 0)
+        self.idle_styling_budget = idle_styling_budget
+        self.styling_timer = QTimer(self)
+        self.styling_timer.setInterval(0)
+        self.styling_timer.timeout.connect(self.style_idle)
+        self.textChanged.connect(self.start_idle_styling)
+
+        # Big changes (opening a file, big pastes) are tokenized in a worker thread,
+        # results for an older revision of the document are thrown away
+        self.revision = 0
+        self.background_revision = None
+        self.tokenizer_worker = TokenizerWorker(self.lexer.tokenizer, parent=self)
+        self.tokenizer_worker.tokenized.connect(self.apply_tokenized)
+        self.SCN_MODIFIED.connect(self.text_modified)
+
+        # Bursts of typing are undone at once, a group of edits ends after a pause
+        self.undo_group_open = False
+        self.undo_timer = QTimer(self)
+        self.undo_timer.setSingleShot(True)
+        self.undo_timer.setInterval(self.UNDO_GROUP_TIMEOUT)
+        self.undo_timer.timeout.connect(self.end_undo_group)
+
+        # The query is validated when the typing stops for validation_debounce milliseconds
+        self.validation_timer = QTimer(self)
+        self.validation_timer.setSingleShot(True)
+        self.validation_timer.timeout.connect(self.request_validation)
+        if validation_debounce > 0:
+            self.validation_timer.setInterval(validation_debounce)
+            self.textChanged.connect(self.validation_timer.start)
 
     def on_margin_clicked(self, nmargin, nline, modifiers):
         # Toggle marker for the line the margin was clicked on
@@ -249,14 +457,121 @@ class RqlEditor(QsciScintilla):
     def selectAll(self):
         super().selectAll(True)
 
-    def undo_loop(self):
-        while True:
-            self.beginUndoAction()
-            sleep(2)
+    def normalized_text(self):
+        # The query without comments and formatting, to recognize the same query.
+        # It runs in the GUI thread, so big documents are not tokenized again
+        text = self.text()
+        if self.length() > self.NORMALIZE_SIZE:
+            return text.encode()
+        return self.lexer.normalize(text)
+
+    def request_validation(self):
+        self.validation_requested.emit(self.revision)
+
+    def show_validation_errors(self, errors):
+        # Underlines the positions of the errors and marks their lines in the margin
+        self.clear_validation_errors()
+        for error in errors:
+            for line, index, end_line, end_index in error_positions(error):
+                if end_line < line or (end_line == line and end_index <= index):
+                    # an empty range, the character at the position is underlined
+                    end_line, end_index = line, index + 1
+                self.fillIndicatorRange(line, index, end_line, end_index, self.ERROR_INDICATOR_NUM)
+                self.markerAdd(line, self.ARROW_MARKER_NUM)
+
+    def clear_validation_errors(self):
+        last_line = max(self.lines() - 1, 0)
+        self.clearIndicatorRange(0, 0, last_line, self.lineLength(last_line), self.ERROR_INDICATOR_NUM)
+        self.markerDeleteAll(self.ARROW_MARKER_NUM)
+
+    def text_modified(self, position, modification_type, text, length, *args):
+        if modification_type & (QsciScintilla.SC_MOD_INSERTTEXT | QsciScintilla.SC_MOD_DELETETEXT):
+            self.revision += 1
+            if modification_type & QsciScintilla.SC_MOD_INSERTTEXT and length >= self.BACKGROUND_STYLING_SIZE:
+                # the snapshot is taken once the modification is finished
+                QTimer.singleShot(0, self.start_background_styling)
+
+    def start_background_styling(self):
+        if self.background_revision == self.revision:
+            return
+        self.background_revision = self.revision
+        self.tokenizer_worker.tokenize(self.revision, self.lexer.text_range(0, self.length()))
+
+    def apply_tokenized(self, revision, styles, line_states):
+        if revision == self.background_revision:
+            self.background_revision = None
+        if revision == self.revision:
+            self.lexer.apply_tokenized(styles, line_states)
+            self.styling_timer.stop()
+            self.styling_progress.emit(100)
+        elif self.background_revision is None:
+            # the document changed in the meantime, the idle styling takes over
+            self.start_idle_styling()
+
+    def start_idle_styling(self):
+        if not self.styling_timer.isActive():
+            self.styling_timer.start()
+
+    def style_idle(self):
+        # Styles chunks of lines after the styled text until the time budget is spent
+        if self.background_revision is not None:
+            # the worker thread is tokenizing the document, it restarts the idle styling if needed
+            self.styling_timer.stop()
+            return
+
+        deadline = perf_counter() + self.idle_styling_budget / 1000
+        length = self.length()
+        end_styled = self.SendScintilla(QsciScintilla.SCI_GETENDSTYLED)
+        while end_styled < length and perf_counter() < deadline:
+            line = self.SendScintilla(QsciScintilla.SCI_LINEFROMPOSITION, end_styled)
+            end = self.SendScintilla(QsciScintilla.SCI_POSITIONFROMLINE, line + self.IDLE_STYLING_LINES)
+            if end < 0 or end > length:
+                end = length
+            self.SendScintilla(QsciScintilla.SCI_COLOURISE, end_styled, end)
+            end_styled = max(end, self.SendScintilla(QsciScintilla.SCI_GETENDSTYLED))
+
+        if end_styled >= length:
+            self.styling_timer.stop()
+            self.styling_progress.emit(100)
+        else:
+            self.styling_progress.emit(int(100 * end_styled / length))
+
+    def keyPressEvent(self, event):
+        # Typing is grouped in a single undo action until there is a pause,
+        # any other key (moving the cursor, shortcuts like undo) ends the group
+        if self.is_typing(event):
+            if not self.undo_group_open:
+                self.beginUndoAction()
+                self.undo_group_open = True
+            self.undo_timer.start()
+        else:
+            self.end_undo_group()
+        super(RqlEditor, self).keyPressEvent(event)
+
+    def mousePressEvent(self, event):
+        self.end_undo_group()
+        super(RqlEditor, self).mousePressEvent(event)
+
+    def is_typing(self, event):
+        if event.key() in [Qt.Key_Backspace, Qt.Key_Delete, Qt.Key_Return, Qt.Key_Enter, Qt.Key_Tab]:
+            return True
+        if event.modifiers() & (Qt.ControlModifier | Qt.AltModifier | Qt.MetaModifier):
+            return False
+        return event.text().isprintable() and event.text() != ''
+
+    def end_undo_group(self):
+        self.undo_timer.stop()
+        if self.undo_group_open:
+            self.undo_group_open = False
             self.endUndoAction()
 
-    def stop(self):
-        self.undo_thread.terminate()
+    def undo(self):
+        self.end_undo_group()
+        super(RqlEditor, self).undo()
+
+    def redo(self):
+        self.end_undo_group()
+        super(RqlEditor, self).redo()
 
     # Some how disabling the editor makes it loose the margin color
     def setEnabled(self, bool):
@@ -0,0 +1,141 @@
+import re
+from array import array
+
+
+class RqlTokenizer(object):
+    """
+    Pure python tokenizer of RQL (no Qt), so it can also run in a worker thread or process.
+    The text is tokenized as UTF-8 bytes and the result is the style number of every byte.
+    """
+    # States at the end of a line
+    DEFAULT = 0
+    MULTILINE_STRING = 1
+
+    def __init__(self, string_style, default_style=0):
+        self.string_style = string_style
+        self.default_style = default_style
+        self.regexes = []
+        # lists of keywords are classified with a lookup of the identifiers: lower case word ->
+        # [(word, style)] in the order the lists were added, word is None for the case insensitive lists
+        self.words = dict()
+        self.master_regex = None
+        self.group_styles = None
+        # the style numbers as single bytes, to fill the styles of a range
+        self.style_bytes = [bytes([n]) for n in range(256)]
+        # multiline string is handled differently, it can span several lines
+        self.multiline_string = re.compile(b'"""')
+        # runs of bytes with the same style and blanks, to normalize a text
+        self.style_runs = re.compile(b'(.)\\1*', re.S)
+        self.blanks = re.compile(br'\s+')
+
+    def add_words(self, words, style, case_sensitive=False):
+        # the first list that contains a word wins
+        for word in words:
+            entries = self.words.setdefault(word.lower().encode(), [])
+            exact = word.encode() if case_sensitive else None
+            # an earlier case insensitive list, or the same word, hides this one
+            if all(other is not None and other != exact for other, _ in entries):
+                entries.append((exact, style))
+
+    def add_regex(self, regex, style, case_sensitive=False):
+        if not case_sensitive:
+            regex = '(?i:%s)' % regex
+        self.regexes.append((regex, style))
+        # the master regex has to be compiled again to include this match
+        self.master_regex = None
+
+    def compile(self):
+        # Joins all the matches in a single regex with a named group per match.
+        # The alternatives are tried in order so the first match added wins,
+        # the opening of a multiline string goes first, then identifiers are classified
+        # with the lists of words and when nothing else matches the next token takes the default style
+        groups = [r'(?P<multiline>"""(?s:.*?"""|.*))']
+        self.group_styles = dict(multiline=self.string_style, default=self.default_style)
+        for n, (regex, style) in enumerate(self.regexes):
+            name = 'match%d' % n
+            groups.append('(?P<%s>%s)' % (name, regex))
+            self.group_styles[name] = style
+        # the text is styled as UTF-8 bytes, non ascii characters are part of the identifiers
+        groups.append(r'(?P<word>(?:\w|[\x80-\xff])+)')
+        groups.append(r'(?P<default>\s+|\W)')
+        self.master_regex = re.compile('|'.join(groups).encode())
+
+    def style_line(self, text, pos, endpos, state, styles):
+        # Styles the line text[pos:endpos] (including its end of line) and returns the state at its end.
+        # The style of every byte is written at the same offset in 'styles', a bytearray initialized
+        # with the default style, so only the tokens with another style have to be written
+        if self.master_regex is None:
+            self.compile()
+
+        style_bytes = self.style_bytes
+        default_style = self.default_style
+        if state == self.MULTILINE_STRING:
+            m = self.multiline_string.search(text, pos, endpos)
+            end = m.end() if m else endpos
+            styles[pos:end] = style_bytes[self.string_style] * (end - pos)
+            if not m:
+                return self.MULTILINE_STRING
+            pos = end
+            state = self.DEFAULT
+
+        # every position matches one of the alternatives, so the tokens are contiguous
+        group_styles = self.group_styles
+        words = self.words
+        for m in self.master_regex.finditer(text, pos, endpos):
+            name = m.lastgroup
+            if name == 'default':
+                continue
+
+            start, end = m.span()
+            if name == 'word':
+                word = m.group()
+                style = default_style
+                for exact, word_style in words.get(word.lower(), ()):
+                    if exact is None or exact == word:
+                        style = word_style
+                        break
+                if style != default_style:
+                    styles[start:end] = style_bytes[style] * (end - start)
+                continue
+
+            styles[start:end] = style_bytes[group_styles[name]] * (end - start)
+            if name == 'multiline':
+                # a multiline string not closed in this line continues in the next one
+                closed = end - start >= 6 and text.endswith(b'"""', start, end)
+                state = self.DEFAULT if closed else self.MULTILINE_STRING
+
+        return state
+
+    def tokenize(self, text, state=DEFAULT):
+        # Tokenizes a whole text (bytes), returns the style of every byte and the state at the end of every line.
+        # Lines end like in Scintilla with \r\n, \r or \n
+        styles = bytearray(self.style_bytes[self.default_style] * len(text))
+        line_states = array('i')
+        pos = 0
+        for line in text.splitlines(True):
+            end = pos + len(line)
+            state = self.style_line(text, pos, end, state, styles)
+            line_states.append(state)
+            pos = end
+        return styles, line_states
+
+    def normalize(self, text, ignored_styles=()):
+        # Returns the text (bytes) with the tokens of ignored_styles (comments) removed and
+        # the blanks between tokens replaced by a single space, so texts that only differ
+        # in formatting give the same result. Strings are kept as they are
+        styles, _ = self.tokenize(text)
+        parts = []
+        for m in self.style_runs.finditer(styles):
+            style = m.group(1)[0]
+            start, end = m.span()
+            if style in ignored_styles:
+                part = b' '
+            elif style == self.default_style:
+                part = self.blanks.sub(b' ', text[start:end])
+            else:
+                part = text[start:end]
+            if parts and parts[-1].endswith(b' ') and part.startswith(b' '):
+                part = part[1:]
+            if part:
+                parts.append(part)
+        return b''.join(parts).strip()
@@ -5,6 +5,7 @@ from PyQt5.QtCore import *
 import sys
 
 from rawapi import new_raw_client, RawException
+from tracing import traced
 
 
 def text_or_none(s):
@@ -37,6 +38,7 @@ def error_box(msg, exception=None):
 
 
 class RegisterDialog(QDialog):
+    @traced()
     def __init__(self, settings):
         super().__init__()
         self.widgets = dict()
@@ -93,6 +95,7 @@ class RegisterDialog(QDialog):
 
 
 class CredentialsListWindow(QDialog):
+    @traced()
     def __init__(self, title, fields):
         super().__init__()
         self.setWindowTitle(title)
@@ -114,6 +117,7 @@ class CredentialsListWindow(QDialog):
         self.refresh()
 
     @exception_dialog
+    @traced()
     def refresh(self):
         data = self.get_rows()
         self.table.clear()
@@ -154,6 +158,7 @@ class CredentialsListWindow(QDialog):
 
 
 class AddBucketDialog(RegisterDialog):
+    @traced()
     def __init__(self, client):
         super().__init__(
             [dict(name='name', type='text', label='Name'),
@@ -185,6 +190,7 @@ class AddBucketDialog(RegisterDialog):
 
 class S3SettingsWindow(CredentialsListWindow):
 
+    @traced()
     def __init__(self):
         super().__init__("S3 Buckets", ['name', 'region', 'credentials'])
 
@@ -209,6 +215,7 @@ class S3SettingsWindow(CredentialsListWindow):
 
 
 class RdbmsSettingsWindow(CredentialsListWindow):
+    @traced()
     def __init__(self):
         super().__init__("RDBMS Servers", ['name', 'type', 'host', 'database', 'port', 'username'])
         self.setGeometry(300, 300, 500, 300)
@@ -234,6 +241,7 @@ class RdbmsSettingsWindow(CredentialsListWindow):
 
 
 class AddRdbmsDialog(RegisterDialog):
+    @traced()
     def __init__(self, client):
         super().__init__(
             [dict(name='name', type='text', label='Name'),
@@ -306,6 +314,7 @@ class AddRdbmsDialog(RegisterDialog):
             self.hide_widget('extra-options')
 
 class AddHttpAuthDialog(RegisterDialog):
+    @traced()
     def __init__(self, client):
         super().__init__(
             [dict(name='name', type='text', label='Url'),
@@ -387,6 +396,7 @@ class AddHttpAuthDialog(RegisterDialog):
 
 
 class HttpSettingsWindow(CredentialsListWindow):
+    @traced()
     def __init__(self):
         super().__init__("Http Auth Urls", ['Url', 'Auth type'])
 
@@ -409,6 +419,7 @@ class HttpSettingsWindow(CredentialsListWindow):
         return values
 
 class PublishWindow(RegisterDialog):
+    @traced()
     def __init__(self, query):
         super().__init__([dict(name='name', type='text', label='Name'),
                          dict(name='publish-as', type='selection', label='Publish As',
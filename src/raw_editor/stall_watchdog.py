@@ -0,0 +1,109 @@
+from PyQt5.QtCore import *
+
+import sys
+import threading
+import time
+from time import perf_counter
+
+
+class StallWatchdog(QObject):
+    """
+    Detects when the Qt event loop of the GUI thread is blocked. A timer of the event loop sends
+    heartbeats, a watchdog thread samples the python stack of the GUI thread (sys._current_frames)
+    while no heartbeat arrives for more than 'threshold' seconds. The blocked time is added up by stack,
+    so the report shows the code paths that block the interface the most.
+    """
+    THRESHOLD = 0.25
+    # milliseconds between heartbeats
+    HEARTBEAT = 50
+    # innermost frames kept of every stack
+    MAX_FRAMES = 20
+
+    # seconds the event loop was blocked, emitted when it runs again
+    stalled = pyqtSignal(float)
+
+    def __init__(self, threshold=THRESHOLD, parent=None):
+        super(StallWatchdog, self).__init__(parent)
+        self.threshold = threshold
+        # created in the GUI thread
+        self.gui_thread = threading.get_ident()
+        self.lock = threading.Lock()
+        self.last_beat = perf_counter()
+        self.last_sample = None
+        # start and first stack of the stall in progress
+        self.current = None
+        # stack -> [seconds blocked, samples]
+        self.stacks = dict()
+        # (duration, first stack) of every stall
+        self.stalls = []
+        self.run = False
+        self.thread = None
+        self.timer = QTimer(self)
+        self.timer.setInterval(self.HEARTBEAT)
+        self.timer.timeout.connect(self.beat)
+
+    def start(self):
+        self.last_beat = perf_counter()
+        self.run = True
+        self.timer.start()
+        self.thread = threading.Thread(name='Stall watchdog', target=self.watch, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.run = False
+        self.timer.stop()
+
+    def beat(self):
+        now = perf_counter()
+        with self.lock:
+            current = self.current
+            self.current = None
+            self.last_beat = now
+            if current is not None:
+                duration = now - current[0]
+                self.stalls.append((duration, current[1]))
+        if current is not None:
+            self.stalled.emit(duration)
+
+    def watch(self):
+        period = max(self.threshold / 2, 0.01)
+        while self.run:
+            time.sleep(period)
+            now = perf_counter()
+            with self.lock:
+                if now - self.last_beat < self.threshold:
+                    continue
+                stack = self.gui_stack()
+                if self.current is None:
+                    # the time since the last heartbeat is blamed on the first stack
+                    self.current = (self.last_beat, stack)
+                    self.last_sample = self.last_beat
+                entry = self.stacks.setdefault(stack, [0, 0])
+                entry[0] += now - self.last_sample
+                entry[1] += 1
+                self.last_sample = now
+
+    def gui_stack(self):
+        frame = sys._current_frames().get(self.gui_thread)
+        stack = []
+        while frame is not None and len(stack) < self.MAX_FRAMES:
+            code = frame.f_code
+            stack.append((code.co_filename, frame.f_lineno, code.co_name))
+            frame = frame.f_back
+        return tuple(reversed(stack))
+
+    def report(self, top=10):
+        # Text with the stalls and the stacks that blocked the event loop the most time
+        with self.lock:
+            stalls = list(self.stalls)
+            stacks = sorted(self.stacks.items(), key=lambda item: -item[1][0])[:top]
+        lines = ['%d stalls longer than %d ms, %.2f s blocked in total' % (
+            len(stalls), self.threshold * 1000, sum(duration for duration, _ in stalls))]
+        if stalls:
+            lines.append('longest stall %.2f s' % max(duration for duration, _ in stalls))
+        for stack, (seconds, samples) in stacks:
+            lines.append('')
+            lines.append('%.2f s blocked (%d samples) in:' % (seconds, samples))
+            for filename, lineno, name in stack:
+                lines.append('  File "%s", line %d, in %s' % (filename, lineno, name))
+        return '\n'.join(lines)
@@ -0,0 +1,124 @@
+"""
+Tracing of the time spent in the editor, the query client and the results, saved as a Chrome trace_event
+JSON file (it can be opened with chrome://tracing or https://ui.perfetto.dev).
+
+Set RAW_EDITOR_TRACE=<file> to trace a whole session, or use Settings > Record trace.
+"""
+import atexit
+import functools
+import json
+import os
+import threading
+from time import perf_counter
+
+TRACE_ENV = 'RAW_EDITOR_TRACE'
+
+
+class Span(object):
+    # Complete event ('ph': 'X') recorded when the block ends
+    __slots__ = ['tracer', 'name', 'args', 'start']
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = 0
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.add(self.name, self.start, perf_counter(), self.args)
+        return False
+
+
+class NoSpan(object):
+    # Used while the tracing is disabled, does nothing
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class Tracer(object):
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.events = []
+        # threads named in the trace
+        self.threads = set()
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.origin = perf_counter()
+        self.no_span = NoSpan()
+
+    def enable(self, path):
+        with self.lock:
+            self.path = path
+            self.events = []
+            self.threads = set()
+            self.origin = perf_counter()
+            self.enabled = True
+
+    def disable(self):
+        # Stops tracing and saves the trace, returns the path of the file
+        if not self.enabled:
+            return None
+        self.enabled = False
+        self.save()
+        return self.path
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return self.no_span
+        return Span(self, name, args)
+
+    def add(self, name, start, end, args):
+        if not self.enabled:
+            return
+        thread = threading.current_thread()
+        tid = threading.get_ident()
+        event = dict(name=name, ph='X', pid=self.pid, tid=tid,
+                     ts=(start - self.origin) * 1e6, dur=(end - start) * 1e6)
+        if args:
+            event['args'] = args
+        with self.lock:
+            if tid not in self.threads:
+                # metadata event with the name of the thread
+                self.threads.add(tid)
+                self.events.append(dict(name='thread_name', ph='M', pid=self.pid, tid=tid,
+                                        args=dict(name=thread.name)))
+            self.events.append(event)
+
+    def save(self):
+        with self.lock:
+            events = list(self.events)
+        with open(self.path, 'w') as f:
+            json.dump(dict(traceEvents=events, displayTimeUnit='ms'), f)
+
+
+tracer = Tracer()
+
+
+def traced(name=None):
+    # Decorator that records a span for every call of the function
+    def decorator(function):
+        span_name = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return function(*args, **kwargs)
+            with Span(tracer, span_name, None):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+if os.environ.get(TRACE_ENV):
+    tracer.enable(os.environ[TRACE_ENV])
+    atexit.register(tracer.disable)